@@ -1,14 +1,27 @@
 import os
 import json
+import logging
+import asyncio
 import time
+import random
+import re
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import copy
+import hashlib
+import hmac
 import io
-from datetime import datetime
-from typing import Optional, Dict, Any
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, Tuple, BinaryIO, Union
 
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from flask import Flask, request
 
 # SQLAlchemy para base de datos
 from sqlalchemy import (
@@ -19,6 +32,7 @@ from sqlalchemy import (
     Text,
     DateTime,
     ForeignKey,
+    select,
 )
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 
@@ -29,18 +43,63 @@ from reportlab.platypus import (
     Spacer,
     Table,
     TableStyle,
-    PageBreak,
+    KeepTogether,
 )
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
 import qrcode
 
+# JSON rápido opcional: si orjson no está instalado se usa json estándar
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Cliente HTTP asíncrono opcional para el polling de /resultados: si httpx no
+# está instalado cada GET se ejecuta con requests en el executor del bucle
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Redis opcional (cachés compartidos entre procesos): solo si hay REDIS_URL
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # =====================================================================
 # 1. CONFIGURACIÓN GENERAL
 # =====================================================================
 
+# ---------------------------------------------------------------
+# 1.0 LOGGING
+# ---------------------------------------------------------------
+# En producción (INFO) los log.debug no formatean ni escriben nada.
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+log = logging.getLogger("bot")
+log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# ---------------------------------------------------------------
+# 1.0.1 JSON
+# ---------------------------------------------------------------
+def _dumps(obj: Any) -> str:
+    """Serializa a JSON (UTF-8 sin escapar, como ensure_ascii=False)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _loads(raw: Any) -> Any:
+    """Deserializa JSON desde str o bytes."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
 # ---------------------------------------------------------------
 # 1.1 TOKEN DEL BOT DE TELEGRAM
 # ---------------------------------------------------------------
@@ -56,6 +115,24 @@ TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 # Ruta de webhook: por defecto usamos el token (puedes cambiarla)
 WEBHOOK_SECRET_PATH = os.getenv("WEBHOOK_SECRET_PATH", TELEGRAM_TOKEN)
 
+# Token secreto que Telegram envía en la cabecera X-Telegram-Bot-Api-Secret-Token
+# (1-256 caracteres A-Z, a-z, 0-9, _ y -). Si se define, el webhook rechaza
+# con 401 cualquier petición sin él antes de leer el cuerpo.
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+
+# URL pública del servicio (ej. https://mi-bot.up.railway.app). Si se define,
+# el webhook se registra al arrancar con WEBHOOK_MAX_CONNECTIONS conexiones
+# simultáneas (Telegram usa 40 por defecto).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+# Únicos tipos de update que procesa el bot; Telegram no envía los demás
+WEBHOOK_ALLOWED_UPDATES = ["message", "edited_message"]
+
+# Sesión HTTP compartida para la Bot API: reutiliza las conexiones TCP+TLS
+# (keep-alive) en lugar de abrir una por cada envío.
+TELEGRAM_HTTP = requests.Session()
+TELEGRAM_HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=64))
+
 # ---------------------------------------------------------------
 # 1.2 CONFIGURACIÓN API HÉRCULES
 # ---------------------------------------------------------------
@@ -73,11 +150,36 @@ API_BASE = os.getenv(
     "https://solutechherculesazf.azurewebsites.net",
 )
 
-# Intervalo entre consultas a /resultados (segundos)
-RESULTADOS_INTERVALO = int(os.getenv("RESULTADOS_INTERVALO", "4"))
+# Sesión HTTP compartida (keep-alive) para las llamadas síncronas a Hércules
+HERCULES_HTTP = requests.Session()
+HERCULES_HTTP.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=64))
+
+# Espera entre consultas a /resultados: backoff exponencial que empieza corto
+# para que las consultas rápidas respondan pronto (BASE, BASE*FACTOR, ... hasta
+# CAP segundos), con un jitter de ±JITTER (fracción). El objetivo es latencia,
+# no menos carga: frente al antiguo intervalo fijo de 4 s se hacen unos 5 GET
+# más por consulta (los de los primeros ~8 s) y a partir de ahí el mismo ritmo.
+# RESULTADOS_INTERVALO (el intervalo fijo anterior) se respeta como CAP si
+# está definido y RESULTADOS_BACKOFF_CAP no.
+RESULTADOS_BACKOFF_BASE = float(os.getenv("RESULTADOS_BACKOFF_BASE", "0.25"))
+RESULTADOS_BACKOFF_FACTOR = float(os.getenv("RESULTADOS_BACKOFF_FACTOR", "1.5"))
+RESULTADOS_BACKOFF_CAP = float(
+    os.getenv("RESULTADOS_BACKOFF_CAP") or os.getenv("RESULTADOS_INTERVALO") or "4.0"
+)
+RESULTADOS_BACKOFF_JITTER = float(os.getenv("RESULTADOS_BACKOFF_JITTER", "0.1"))
 # Tiempo máximo de espera total para resultados (segundos)
 RESULTADOS_TIMEOUT = int(os.getenv("RESULTADOS_TIMEOUT", "180"))
 
+# Vigencia (segundos) y tamaño máximo del estado de conversación por chat
+ESTADO_TTL = int(os.getenv("ESTADO_TTL", "1800"))
+ESTADO_MAXSIZE = int(os.getenv("ESTADO_MAXSIZE", "100000"))
+
+# Hilos que procesan updates de Telegram fuera del request del webhook
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+
+# Hilos que cierran las consultas (cobro, formateo, PDF y envíos)
+CONSULTA_WORKERS = int(os.getenv("CONSULTA_WORKERS", "32"))
+
 # ---------------------------------------------------------------
 # 1.3 CONFIGURACIÓN BASE DE DATOS
 # ---------------------------------------------------------------
@@ -101,8 +203,47 @@ if DATABASE_URL.startswith("mysql+pymysql://") and "charset=" not in DATABASE_UR
     sep = "&" if "?" in DATABASE_URL else "?"
     DATABASE_URL = f"{DATABASE_URL}{sep}charset=utf8mb4"
 
-engine = create_engine(DATABASE_URL, echo=False, future=True)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+# Pool de conexiones para MySQL: LIFO para reutilizar las conexiones
+# calientes, pre_ping para descartar las que el servidor cerró y recycle
+# por debajo del wait_timeout. SQLite local usa el pool por defecto.
+engine_kwargs: Dict[str, Any] = {"echo": False, "future": True}
+if not DATABASE_URL.startswith("sqlite"):
+    engine_kwargs.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "5")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=True,
+        pool_use_lifo=True,
+    )
+
+engine = create_engine(DATABASE_URL, **engine_kwargs)
+SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
+
+# Vigencia (segundos) del caché en memoria de usuarios por telegram_id
+USUARIO_CACHE_TTL = int(os.getenv("USUARIO_CACHE_TTL", "60"))
+USUARIO_CACHE_MAXSIZE = int(os.getenv("USUARIO_CACHE_MAXSIZE", "10000"))
+
+# Vigencia (segundos) del caché de consultas_config; 0 = no refrescar nunca
+CONSULTA_CONFIG_TTL = int(os.getenv("CONSULTA_CONFIG_TTL", "60"))
+
+# Vigencia (segundos) del saldo de créditos cacheado para /saldo
+CREDITOS_CACHE_TTL = int(os.getenv("CREDITOS_CACHE_TTL", "10"))
+CREDITOS_CACHE_MAXSIZE = int(os.getenv("CREDITOS_CACHE_MAXSIZE", "10000"))
+
+# ---------------------------------------------------------------
+# 1.4 REDIS (OPCIONAL)
+# ---------------------------------------------------------------
+# Sin REDIS_URL (o sin el paquete redis) los cachés viven en memoria del
+# proceso, que basta con un solo worker de gunicorn.
+REDIS_URL = os.getenv("REDIS_URL")
+
+redis_client = None
+if REDIS_URL:
+    if redis is None:
+        log.warning("REDIS_URL definido pero el paquete redis no está instalado; se usa memoria.")
+    else:
+        redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=1, health_check_interval=30)
 
 # =====================================================================
 # 2. MODELOS DE BASE DE DATOS
@@ -178,6 +319,11 @@ class ConsultaConfig(Base):
     valor_consulta = Column(Integer, default=5000, nullable=False)
     estado_consulta = Column(String(20), default="ACTIVA", nullable=False)
 
+
+# Tablas Core para las escrituras del camino caliente (sin ORM)
+USUARIOS = Usuario.__table__
+MENSAJES = Mensaje.__table__
+
 # =====================================================================
 # 3. CONSTANTES DE TIPO DE CONSULTA (CATÁLOGO HÉRCULES)
 # =====================================================================
@@ -236,7 +382,38 @@ def init_db() -> None:
         db.close()
 
 
+# tipo_consulta -> copia en memoria de su fila en consultas_config
+CONSULTA_CONFIG_CACHE: Dict[int, SimpleNamespace] = {}
+# Momento (time.monotonic()) de la última carga de CONSULTA_CONFIG_CACHE
+_CONSULTA_CONFIG_CARGADA = 0.0
+
+
+def reload_consulta_config() -> None:
+    """
+    Carga consultas_config completa en CONSULTA_CONFIG_CACHE.
+    get_consulta_config la vuelve a llamar cada CONSULTA_CONFIG_TTL segundos;
+    si se editan las filas en la BD, llamarla para aplicar el cambio ya.
+    """
+    global CONSULTA_CONFIG_CACHE, _CONSULTA_CONFIG_CARGADA
+
+    db = SessionLocal()
+    try:
+        CONSULTA_CONFIG_CACHE = {
+            c.tipo_consulta: SimpleNamespace(
+                tipo_consulta=c.tipo_consulta,
+                nombre_servicio=c.nombre_servicio,
+                valor_consulta=c.valor_consulta,
+                estado_consulta=c.estado_consulta,
+            )
+            for c in db.query(ConsultaConfig).all()
+        }
+        _CONSULTA_CONFIG_CARGADA = time.monotonic()
+    finally:
+        db.close()
+
+
 init_db()
+reload_consulta_config()
 
 # =====================================================================
 # 5. FUNCIONES AUXILIARES DE BD
@@ -246,9 +423,123 @@ def get_db():
     return SessionLocal()
 
 
-def get_or_create_usuario_from_update(update: dict) -> Usuario:
+@dataclass(frozen=True)
+class UsuarioSnapshot:
+    """
+    Copia desacoplada de la sesión con los campos de Usuario que usa el bot.
+    """
+    id: int
+    telegram_id: str
+    creditos_total: int
+    creditos_usados: int
+    rol: str
+
+
+# telegram_id -> (momento de carga en time.monotonic(), snapshot); al superar
+# USUARIO_CACHE_MAXSIZE se descartan primero los cargados hace más tiempo
+_USER_CACHE: "OrderedDict[str, Tuple[float, UsuarioSnapshot]]" = OrderedDict()
+_USER_CACHE_LOCK = threading.Lock()
+
+
+def _user_cache_get(telegram_id: str) -> Optional[UsuarioSnapshot]:
+    """Snapshot cacheado si tiene menos de USUARIO_CACHE_TTL segundos."""
+    with _USER_CACHE_LOCK:
+        cached = _USER_CACHE.get(telegram_id)
+    if cached and time.monotonic() - cached[0] < USUARIO_CACHE_TTL:
+        return cached[1]
+    return None
+
+
+def _user_cache_guardar(snapshot: UsuarioSnapshot) -> None:
+    with _USER_CACHE_LOCK:
+        _USER_CACHE[snapshot.telegram_id] = (time.monotonic(), snapshot)
+        _USER_CACHE.move_to_end(snapshot.telegram_id)
+        while len(_USER_CACHE) > USUARIO_CACHE_MAXSIZE:
+            _USER_CACHE.popitem(last=False)
+
+
+def _user_cache_invalidar(telegram_id: str) -> None:
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(telegram_id, None)
+
+
+def _snapshot_usuario(usuario: Usuario) -> UsuarioSnapshot:
+    snapshot = UsuarioSnapshot(
+        id=usuario.id,
+        telegram_id=usuario.telegram_id,
+        creditos_total=usuario.creditos_total,
+        creditos_usados=usuario.creditos_usados,
+        rol=usuario.rol,
+    )
+    _user_cache_guardar(snapshot)
+    return snapshot
+
+
+# usuario_id -> (momento de carga en time.monotonic(), (total, usados));
+# solo se usa si no hay Redis. Al superar CREDITOS_CACHE_MAXSIZE se descartan
+# primero los cargados hace más tiempo
+_CREDITOS_CACHE: "OrderedDict[int, Tuple[float, Tuple[int, int]]]" = OrderedDict()
+_CREDITOS_CACHE_LOCK = threading.Lock()
+
+
+def _clave_creditos(usuario_id: int) -> str:
+    return f"u:{usuario_id}:cred"
+
+
+def leer_creditos_cacheados(usuario_id: int) -> Tuple[int, int]:
+    """
+    (creditos_total, creditos_usados) para mostrar en /saldo, cacheados
+    CREDITOS_CACHE_TTL segundos en Redis (o en memoria si no hay Redis).
+    No usar antes de cobrar: ahí se lee la BD con leer_creditos.
+    """
+    if redis_client is not None:
+        try:
+            raw = redis_client.get(_clave_creditos(usuario_id))
+            if raw:
+                total, usados = map(int, raw.split(b":"))
+                return total, usados
+        except redis.RedisError:
+            log.exception("Redis: no se pudo leer créditos cacheados")
+    else:
+        with _CREDITOS_CACHE_LOCK:
+            cached = _CREDITOS_CACHE.get(usuario_id)
+        if cached and time.monotonic() - cached[0] < CREDITOS_CACHE_TTL:
+            return cached[1]
+
+    with get_db() as db:
+        total, usados = leer_creditos(db, usuario_id)
+
+    if redis_client is not None:
+        try:
+            redis_client.setex(_clave_creditos(usuario_id), CREDITOS_CACHE_TTL, f"{total}:{usados}")
+        except redis.RedisError:
+            log.exception("Redis: no se pudo guardar créditos cacheados")
+    else:
+        with _CREDITOS_CACHE_LOCK:
+            _CREDITOS_CACHE[usuario_id] = (time.monotonic(), (total, usados))
+            _CREDITOS_CACHE.move_to_end(usuario_id)
+            while len(_CREDITOS_CACHE) > CREDITOS_CACHE_MAXSIZE:
+                _CREDITOS_CACHE.popitem(last=False)
+    return total, usados
+
+
+def invalidar_creditos_cacheados(usuario_id: int) -> None:
+    if redis_client is not None:
+        try:
+            redis_client.delete(_clave_creditos(usuario_id))
+        except redis.RedisError:
+            log.exception("Redis: no se pudo invalidar créditos cacheados")
+    else:
+        with _CREDITOS_CACHE_LOCK:
+            _CREDITOS_CACHE.pop(usuario_id, None)
+
+
+def get_or_create_usuario_from_update(update: dict) -> UsuarioSnapshot:
     """
     Localiza o crea el usuario de Telegram que envía el mensaje.
+
+    Usa un caché en memoria por telegram_id (USUARIO_CACHE_TTL segundos)
+    para no consultar la BD en cada update del mismo usuario.
     """
     message = update.get("message") or update.get("edited_message")
     if not message:
@@ -257,6 +548,10 @@ def get_or_create_usuario_from_update(update: dict) -> Usuario:
     from_user = message["from"]
     telegram_id = str(from_user["id"])
 
+    cached = _user_cache_get(telegram_id)
+    if cached is not None:
+        return cached
+
     db = get_db()
     try:
         usuario = db.query(Usuario).filter_by(telegram_id=telegram_id).one_or_none()
@@ -266,7 +561,7 @@ def get_or_create_usuario_from_update(update: dict) -> Usuario:
             usuario.last_name = from_user.get("last_name")
             db.commit()
             db.refresh(usuario)
-            return usuario
+            return _snapshot_usuario(usuario)
 
         usuario = Usuario(
             telegram_id=telegram_id,
@@ -280,32 +575,46 @@ def get_or_create_usuario_from_update(update: dict) -> Usuario:
         db.add(usuario)
         db.commit()
         db.refresh(usuario)
-        return usuario
+        return _snapshot_usuario(usuario)
     finally:
         db.close()
 
 
-def get_consulta_config(tipo_consulta: int) -> Optional[ConsultaConfig]:
-    db = get_db()
-    try:
-        return (
-            db.query(ConsultaConfig)
-            .filter_by(tipo_consulta=tipo_consulta)
-            .one_or_none()
-        )
-    finally:
-        db.close()
+def get_consulta_config(tipo_consulta: int) -> Optional[SimpleNamespace]:
+    """
+    Configuración de la consulta desde el caché en memoria; solo va a la BD
+    cuando el caché tiene más de CONSULTA_CONFIG_TTL segundos.
+    """
+    if CONSULTA_CONFIG_TTL and time.monotonic() - _CONSULTA_CONFIG_CARGADA >= CONSULTA_CONFIG_TTL:
+        try:
+            reload_consulta_config()
+        except Exception:
+            # Si la BD falla se sigue con la copia anterior
+            log.exception("No se pudo refrescar consultas_config")
+    return CONSULTA_CONFIG_CACHE.get(tipo_consulta)
 
 
 def usuario_creditos_disponibles(usuario: Usuario) -> int:
     """
     total - usados (no puede ser negativo)
+    Acepta cualquier objeto con creditos_total/creditos_usados (entidad o fila).
     """
     return max(usuario.creditos_total - usuario.creditos_usados, 0)
 
 
+def leer_creditos(db, usuario_id: int):
+    """
+    Lee solo las columnas de créditos del usuario (fila Core, sin hidratar
+    la entidad Usuario en la sesión).
+    """
+    return db.execute(
+        select(USUARIOS.c.creditos_total, USUARIOS.c.creditos_usados)
+        .where(USUARIOS.c.id == usuario_id)
+    ).one()
+
+
 def registrar_mensaje_pendiente(
-    usuario: Usuario,
+    usuario: UsuarioSnapshot,
     tipo_consulta: int,
     nombre_servicio: str,
     parametros: Dict[str, Any],
@@ -314,23 +623,24 @@ def registrar_mensaje_pendiente(
     """
     Registra la consulta en estado 'pendiente'.
     No descuenta créditos todavía.
+
+    Se inserta con SQLAlchemy Core (sin instanciar Mensaje en el ORM).
     """
     db = get_db()
     try:
-        usuario_db = db.query(Usuario).filter_by(id=usuario.id).one()
-
-        msg = Mensaje(
-            usuario_id=usuario_db.id,
-            tipo_consulta=tipo_consulta,
-            nombre_servicio=nombre_servicio,
-            parametros=json.dumps(parametros, ensure_ascii=False),
-            creditos_costo=valor_consulta,
-            estado="pendiente",
+        res = db.execute(
+            MENSAJES.insert().values(
+                usuario_id=usuario.id,
+                tipo_consulta=tipo_consulta,
+                nombre_servicio=nombre_servicio,
+                parametros=_dumps(parametros),
+                creditos_costo=valor_consulta,
+                estado="pendiente",
+                fecha_creacion=datetime.utcnow(),
+            )
         )
-        db.add(msg)
         db.commit()
-        db.refresh(msg)
-        return msg.id
+        return res.inserted_primary_key[0]
     finally:
         db.close()
 
@@ -338,22 +648,41 @@ def registrar_mensaje_pendiente(
 def marcar_mensaje_exito_y_cobrar(mensaje_id: int, respuesta_bruta: dict) -> None:
     """
     Marca el mensaje como 'exito' y descuenta créditos al usuario asociado.
+
+    Todo ocurre en una sola transacción con sentencias Core (sin cargar
+    entidades ORM); el descuento es un UPDATE atómico sobre creditos_usados.
     """
     db = get_db()
     try:
-        msg = db.query(Mensaje).filter_by(id=mensaje_id).one_or_none()
-        if not msg:
-            return
-
-        usuario = db.query(Usuario).filter_by(id=msg.usuario_id).one()
-
-        msg.estado = "exito"
-        msg.respuesta_bruta = json.dumps(respuesta_bruta, ensure_ascii=False)
+        with db.begin():
+            fila = db.execute(
+                select(MENSAJES.c.usuario_id, MENSAJES.c.creditos_costo, USUARIOS.c.telegram_id)
+                .join_from(MENSAJES, USUARIOS, MENSAJES.c.usuario_id == USUARIOS.c.id)
+                .where(MENSAJES.c.id == mensaje_id)
+            ).one_or_none()
+            if not fila:
+                return
 
-        usuario.creditos_usados += msg.creditos_costo
-        usuario.ultima_consulta = datetime.utcnow()
+            db.execute(
+                MENSAJES.update()
+                .where(MENSAJES.c.id == mensaje_id)
+                .values(
+                    estado="exito",
+                    respuesta_bruta=_dumps(respuesta_bruta),
+                )
+            )
+            db.execute(
+                USUARIOS.update()
+                .where(USUARIOS.c.id == fila.usuario_id)
+                .values(
+                    creditos_usados=USUARIOS.c.creditos_usados + fila.creditos_costo,
+                    ultima_consulta=datetime.utcnow(),
+                )
+            )
 
-        db.commit()
+        # Los créditos cambiaron: el snapshot y el saldo en caché ya no son válidos
+        _user_cache_invalidar(fila.telegram_id)
+        invalidar_creditos_cacheados(fila.usuario_id)
     finally:
         db.close()
 
@@ -368,17 +697,14 @@ def marcar_mensaje_error_o_sin_datos(
     Marca el mensaje como 'error' o 'sin_datos'.
     No descuenta créditos.
     """
+    valores = {"estado": estado, "mensaje_error": mensaje_error or estado}
+    if respuesta_bruta is not None:
+        valores["respuesta_bruta"] = _dumps(respuesta_bruta)
+
     db = get_db()
     try:
-        msg = db.query(Mensaje).filter_by(id=mensaje_id).one_or_none()
-        if not msg:
-            return
-
-        msg.estado = estado
-        msg.mensaje_error = mensaje_error or estado
-        if respuesta_bruta is not None:
-            msg.respuesta_bruta = json.dumps(respuesta_bruta, ensure_ascii=False)
-
+        # Un UPDATE sin filas afectadas equivale al antiguo "si no existe, salir"
+        db.execute(MENSAJES.update().where(MENSAJES.c.id == mensaje_id).values(**valores))
         db.commit()
     finally:
         db.close()
@@ -387,36 +713,37 @@ def marcar_mensaje_error_o_sin_datos(
 # 6. TEXTOS Y TECLADOS TELEGRAM
 # =====================================================================
 
-# Intentamos importar textos.py; si no existe, definimos valores por defecto
-try:
-    import textos
-except ImportError:
-    class textos:
-        MENSAJE_BIENVENIDA = (
-            "👋 *Bienvenido a Bot_Telegram_V1.1*\n\n"
-            "Elige el tipo de consulta con los botones de abajo.\n\n"
-            "Modo rápido (firma): `CC 123456789`.\n"
-            "Escribe `/saldo` para ver tus créditos."
-        )
-        MENSAJE_SIN_CREDITOS = (
-            "⚠️ No tienes créditos suficientes para realizar esta consulta."
-        )
-        MENSAJE_ERROR_GENERICO = (
-            "❌ Ocurrió un error realizando la consulta.\n"
-            "Por favor inténtalo de nuevo más tarde."
-        )
-        MENSAJE_SIN_DATOS = "ℹ️ La consulta fue procesada pero no se encontraron datos para los parámetros enviados."
-        MENSAJE_SALDO = (
-            "💰 *Tu saldo de créditos*\n\n"
-            "Totales: {total}\n"
-            "Usados: {usados}\n"
-            "Disponibles: {disponibles}\n"
-        )
+# Textos del bot: textos.py es la única fuente (viaja junto a bot.py)
+import textos
+
+
+# Plantilla de /saldo ligada una sola vez (evita resolver textos.MENSAJE_SALDO.format
+# en cada llamada)
+FORMATO_SALDO = textos.MENSAJE_SALDO.format
+
+# Pedido del número de documento tras elegir el tipo (firma / persona)
+FORMATO_PEDIR_NUM_DOC_FIRMA = (
+    "✍️ Has elegido *firma* con documento tipo *{tipo_doc}*.\n\n"
+    "👉 Escribe ahora el *número de documento* (sin puntos ni comas)."
+).format
+FORMATO_PEDIR_NUM_DOC_PERSONA = (
+    "🧍 Has elegido *persona* con documento tipo *{tipo_doc}*.\n\n"
+    "👉 Escribe ahora el *número de documento* (sin puntos ni comas)."
+).format
 
 
-def enviar_mensaje(chat_id: int, texto: str, reply_markup: Optional[dict] = None):
+def enviar_mensaje(
+    chat_id: int,
+    texto: str,
+    reply_markup: Optional[Any] = None,
+    as_response: bool = False,
+) -> Optional[dict]:
     """
     Wrapper para enviar mensajes a Telegram.
+    reply_markup puede ser un dict o un JSON ya serializado (str).
+
+    Con as_response=True no hace la llamada HTTP: devuelve el payload
+    {"method": "sendMessage", ...} para responderlo en el cuerpo del webhook.
     """
     payload = {
         "chat_id": chat_id,
@@ -426,111 +753,274 @@ def enviar_mensaje(chat_id: int, texto: str, reply_markup: Optional[dict] = None
     if reply_markup is not None:
         payload["reply_markup"] = reply_markup
 
+    if as_response:
+        return {"method": "sendMessage", **payload}
+
     try:
-        resp = requests.post(f"{TELEGRAM_API_URL}/sendMessage", json=payload, timeout=20)
+        resp = TELEGRAM_HTTP.post(f"{TELEGRAM_API_URL}/sendMessage", json=payload, timeout=20)
         resp.raise_for_status()
-    except Exception as e:
-        print(f"[ERROR] Enviando mensaje a Telegram: {e}")
+    except Exception:
+        log.exception("Enviando mensaje a Telegram")
+    return None
+
+
+# hash(firma_b64) -> file_id de Telegram de la firma ya subida (LRU)
+FIRMA_FILE_IDS: "OrderedDict[str, str]" = OrderedDict()
+FIRMA_FILE_IDS_MAX = 1024
+_FIRMA_FILE_IDS_LOCK = threading.Lock()
+
+
+def _firma_file_id(clave: str) -> Optional[str]:
+    with _FIRMA_FILE_IDS_LOCK:
+        file_id = FIRMA_FILE_IDS.get(clave)
+        if file_id:
+            FIRMA_FILE_IDS.move_to_end(clave)
+        return file_id
+
+
+def _guardar_firma_file_id(clave: str, file_id: str) -> None:
+    with _FIRMA_FILE_IDS_LOCK:
+        FIRMA_FILE_IDS[clave] = file_id
+        FIRMA_FILE_IDS.move_to_end(clave)
+        while len(FIRMA_FILE_IDS) > FIRMA_FILE_IDS_MAX:
+            FIRMA_FILE_IDS.popitem(last=False)
 
 
 def enviar_documento_firma_desde_b64(chat_id: int, firma_b64: str):
     """
     Decodifica la firma en base64 y la envía a Telegram como documento (GIF/imagen).
+
+    Si esa misma firma ya se subió antes, se reenvía por su file_id de
+    Telegram sin decodificarla ni volver a subir los bytes.
     """
     try:
         if not firma_b64:
             return
 
+        data = {
+            "chat_id": chat_id,
+            "caption": "🖊 Firma registrada",
+        }
+
+        clave = hashlib.blake2b(firma_b64.encode(), digest_size=16).hexdigest()
+        file_id = _firma_file_id(clave)
+        if file_id:
+            resp = TELEGRAM_HTTP.post(
+                f"{TELEGRAM_API_URL}/sendDocument",
+                data={**data, "document": file_id},
+                timeout=30,
+            )
+            if resp.ok:
+                log.debug("Firma reenviada a Telegram por file_id")
+                return
+            # file_id rechazado: se descarta y se sube de nuevo
+            with _FIRMA_FILE_IDS_LOCK:
+                FIRMA_FILE_IDS.pop(clave, None)
+
         image_bytes = base64.b64decode(firma_b64)
 
         files = {
             "document": ("firma.gif", image_bytes)  # la firma es un GIF (R0lGOD...)
         }
-        data = {
-            "chat_id": chat_id,
-            "caption": "🖊 Firma registrada",
-        }
 
-        resp = requests.post(
+        resp = TELEGRAM_HTTP.post(
             f"{TELEGRAM_API_URL}/sendDocument",
             data=data,
             files=files,
             timeout=30,
         )
         resp.raise_for_status()
-        print("[DEBUG] Firma enviada como documento a Telegram")
-    except Exception as e:
-        print(f"[ERROR] Enviando imagen de firma a Telegram: {e}")
+        log.debug("Firma enviada como documento a Telegram")
+
+        # Telegram puede devolver un GIF como 'animation' además de 'document'
+        result = _loads(resp.content).get("result") or {}
+        adjunto = result.get("document") or result.get("animation") or {}
+        if adjunto.get("file_id"):
+            _guardar_firma_file_id(clave, adjunto["file_id"])
+    except Exception:
+        log.exception("Enviando imagen de firma a Telegram")
 
 
-def enviar_documento_pdf(chat_id: int, nombre_archivo: str, pdf_bytes: bytes):
+def enviar_documento_pdf(chat_id: int, nombre_archivo: str, pdf: Union[bytes, BinaryIO]):
     """
-    Envía un PDF a Telegram como documento, usando bytes en memoria.
+    Envía un PDF a Telegram como documento.
+    'pdf' puede ser bytes o un archivo/BytesIO posicionado al inicio.
     """
     try:
         files = {
-            "document": (nombre_archivo, pdf_bytes, "application/pdf")
+            "document": (nombre_archivo, pdf, "application/pdf")
         }
         data = {
             "chat_id": chat_id,
             "caption": "📄 Informe vehicular generado",
         }
 
-        resp = requests.post(
+        resp = TELEGRAM_HTTP.post(
             f"{TELEGRAM_API_URL}/sendDocument",
             data=data,
             files=files,
             timeout=30,
         )
         resp.raise_for_status()
-        print("[DEBUG] PDF vehicular enviado como documento a Telegram")
-    except Exception as e:
-        print(f"[ERROR] Enviando PDF vehicular a Telegram: {e}")
+        log.debug("PDF vehicular enviado como documento a Telegram")
+    except Exception:
+        log.exception("Enviando PDF vehicular a Telegram")
 
 
-def teclado_menu_principal():
+def registrar_webhook() -> None:
     """
-    Teclado principal.
+    Registra {WEBHOOK_URL}/webhook/{WEBHOOK_SECRET_PATH} en Telegram con
+    max_connections=WEBHOOK_MAX_CONNECTIONS y solo los updates de
+    WEBHOOK_ALLOWED_UPDATES. setWebhook es idempotente, así que se puede
+    llamar en cada arranque.
     """
-    return {
-        "keyboard": [
-            ["📝 Consulta de firma", "🧍 Consulta de persona"],
-            ["🚗 Consulta de vehículo", "👤 Propietario por placa"],
-            ["/saldo"],
-        ],
-        "resize_keyboard": True,
-        "one_time_keyboard": False,
-    }
+    try:
+        resp = TELEGRAM_HTTP.post(
+            f"{TELEGRAM_API_URL}/setWebhook",
+            json={
+                "url": f"{WEBHOOK_URL.rstrip('/')}/webhook/{WEBHOOK_SECRET_PATH}",
+                "max_connections": WEBHOOK_MAX_CONNECTIONS,
+                "allowed_updates": WEBHOOK_ALLOWED_UPDATES,
+                **({"secret_token": WEBHOOK_SECRET_TOKEN} if WEBHOOK_SECRET_TOKEN else {}),
+            },
+            timeout=20,
+        )
+        resp.raise_for_status()
+        log.info("Webhook registrado en Telegram (max_connections=%s)", WEBHOOK_MAX_CONNECTIONS)
+    except Exception:
+        log.exception("Registrando webhook en Telegram")
 
 
-def teclado_tipos_documento():
-    """
-    Teclado para elegir tipo de documento (CC, TI, NIT).
-    Útil tanto para firma como para persona.
-    """
-    return {
-        "keyboard": [
-            ["CC - Cédula", "TI - Tarjeta de identidad"],
-            ["NIT - NIT"],
-            ["⬅ Volver al menú"],
-        ],
-        "resize_keyboard": True,
-        "one_time_keyboard": False,
-    }
+if WEBHOOK_URL:
+    registrar_webhook()
+
+
+# Teclados estáticos: se construyen y serializan una sola vez al importar.
+# Telegram acepta reply_markup como objeto JSON ya serializado (str).
+MENU_PRINCIPAL = {
+    "keyboard": [
+        ["📝 Consulta de firma", "🧍 Consulta de persona"],
+        ["🚗 Consulta de vehículo", "👤 Propietario por placa"],
+        ["/saldo"],
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": False,
+}
+
+MENU_TIPOS_DOC = {
+    "keyboard": [
+        ["CC - Cédula", "TI - Tarjeta de identidad"],
+        ["NIT - NIT"],
+        ["⬅ Volver al menú"],
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": False,
+}
+
+MENU_PRINCIPAL_JSON = json.dumps(MENU_PRINCIPAL, ensure_ascii=False)
+MENU_TIPOS_DOC_JSON = json.dumps(MENU_TIPOS_DOC, ensure_ascii=False)
+
 
 # =====================================================================
-# 7. ESTADO EN MEMORIA POR USUARIO
+# 7. ESTADO DE CONVERSACIÓN POR USUARIO (MEMORIA O REDIS)
 # =====================================================================
 
-user_states: Dict[int, Dict[str, Any]] = {}
+class EstadosEnMemoria:
+    """
+    Estado de conversación por chat_id, seguro entre hilos.
+    Cada entrada caduca tras `ttl` segundos sin escribirse y, al superar
+    `maxsize`, se descartan primero las menos recientes.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._datos: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._datos.get(chat_id)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira <= time.monotonic():
+                del self._datos[chat_id]
+                return None
+            return valor
+
+    def set(self, chat_id: int, valor: Dict[str, Any]) -> None:
+        with self._lock:
+            self._datos[chat_id] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(chat_id)
+            while len(self._datos) > self.maxsize:
+                self._datos.popitem(last=False)
+
+    def delete(self, chat_id: int) -> None:
+        with self._lock:
+            self._datos.pop(chat_id, None)
+
+
+class EstadosEnRedis:
+    """
+    Misma interfaz que EstadosEnMemoria pero en un hash de Redis por chat
+    (st:{chat_id} con los campos estado y datos en JSON), compartido entre
+    procesos. La vigencia se renueva en cada escritura.
+    """
+
+    def __init__(self, cliente, ttl: int):
+        self.cliente = cliente
+        self.ttl = ttl
+
+    @staticmethod
+    def _clave(chat_id: int) -> str:
+        return f"st:{chat_id}"
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            raw = self.cliente.hgetall(self._clave(chat_id))
+        except redis.RedisError:
+            log.exception("Redis: no se pudo leer el estado de %s", chat_id)
+            return None
+        if not raw:
+            return None
+        return {
+            "estado": raw.get(b"estado", b"").decode() or None,
+            "datos": _loads(raw.get(b"datos") or b"{}"),
+        }
+
+    def set(self, chat_id: int, valor: Dict[str, Any]) -> None:
+        clave = self._clave(chat_id)
+        try:
+            pipe = self.cliente.pipeline()
+            pipe.hset(clave, mapping={"estado": valor["estado"] or "", "datos": _dumps(valor["datos"])})
+            pipe.expire(clave, self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            log.exception("Redis: no se pudo guardar el estado de %s", chat_id)
+
+    def delete(self, chat_id: int) -> None:
+        try:
+            self.cliente.delete(self._clave(chat_id))
+        except redis.RedisError:
+            log.exception("Redis: no se pudo borrar el estado de %s", chat_id)
+
+
+if redis_client is not None:
+    user_states = EstadosEnRedis(redis_client, ttl=ESTADO_TTL)
+else:
+    user_states = EstadosEnMemoria(maxsize=ESTADO_MAXSIZE, ttl=ESTADO_TTL)
 
 
 def set_user_state(chat_id: int, estado: Optional[str], datos: Optional[Dict[str, Any]] = None):
-    user_states[chat_id] = {"estado": estado, "datos": datos or {}}
+    if estado is None and not datos:
+        user_states.delete(chat_id)
+        return
+    user_states.set(chat_id, {"estado": estado, "datos": datos or {}})
 
 
 def get_user_state(chat_id: int) -> Dict[str, Any]:
-    return user_states.get(chat_id, {"estado": None, "datos": {}})
+    return user_states.get(chat_id) or {"estado": None, "datos": {}}
 
 # =====================================================================
 # 8. LLAMADAS A LA API HÉRCULES
@@ -550,12 +1040,12 @@ def llamar_iniciar_consulta(tipo_consulta: int, mensaje_payload: Any) -> str:
 
     Además:
       - Si mensaje_payload es dict/list -> se serializa a JSON.
-      - Si mensaje_payload es str -> se manda tal cual (sin json.dumps).
+      - Si mensaje_payload es str -> se manda tal cual (sin serializar).
     """
     url = f"{API_BASE}/api/IniciarConsulta"
 
     if isinstance(mensaje_payload, (dict, list)):
-        mensaje_str = json.dumps(mensaje_payload, ensure_ascii=False)
+        mensaje_str = _dumps(mensaje_payload)
     else:
         mensaje_str = str(mensaje_payload)
 
@@ -565,18 +1055,18 @@ def llamar_iniciar_consulta(tipo_consulta: int, mensaje_payload: Any) -> str:
         "mensaje": mensaje_str,
     }
 
-    print(f"[DEBUG] IniciarConsulta payload: {body}")
+    log.debug("IniciarConsulta payload: %s", body)
 
-    resp = requests.post(url, json=body, timeout=30)
+    resp = HERCULES_HTTP.post(url, json=body, timeout=30)
 
     try:
         resp.raise_for_status()
     except Exception:
-        print(f"[ERROR] HTTP IniciarConsulta status={resp.status_code}, body={resp.text}")
+        log.error("HTTP IniciarConsulta status=%s, body=%s", resp.status_code, resp.text)
         raise
 
-    data = resp.json()
-    print(f"[DEBUG] Respuesta IniciarConsulta: {data}")
+    data = _loads(resp.content)
+    log.debug("Respuesta IniciarConsulta: %s", data)
 
     # Formato NUEVO
     id_peticion = data.get("IdPeticion") or data.get("idPeticion")
@@ -601,17 +1091,57 @@ def llamar_resultados(id_peticion: str) -> dict:
     Llama a GET /api/resultados/{token}/{idPeticion}
     Respuesta esperada:
       { "Tipo": 0|1|2, "Mensaje": "..." }
+
+    Devuelve el objeto tal como llega (se guarda en respuesta_bruta); para
+    las comprobaciones usar _normalizar_resultados.
+    """
+    resp = HERCULES_HTTP.get(_url_resultados(id_peticion), timeout=30)
+    return _datos_resultados(resp)
+
+
+async def llamar_resultados_async(id_peticion: str) -> dict:
     """
-    url = f"{API_BASE}/api/resultados/{HERCULES_TOKEN}/{id_peticion}"
+    Igual que llamar_resultados pero con el httpx.AsyncClient compartido:
+    la espera de red no ocupa ningún hilo. Solo se usa si httpx está instalado.
+    """
+    resp = await _RESULTADOS_CLIENT.get(_url_resultados(id_peticion))
+    return _datos_resultados(resp)
+
+
+def _url_resultados(id_peticion: str) -> str:
+    return f"{API_BASE}/api/resultados/{HERCULES_TOKEN}/{id_peticion}"
+
 
-    resp = requests.get(url, timeout=30)
+def _datos_resultados(resp) -> dict:
+    """Valida una respuesta de /resultados (requests o httpx) y la decodifica."""
     if resp.status_code != 200:
-        print(f"[ERROR] HTTP resultados status={resp.status_code}, body={resp.text}")
+        log.error("HTTP resultados status=%s, body=%s", resp.status_code, resp.text)
         resp.raise_for_status()
 
-    data = resp.json()
-    print(f"[DEBUG] Respuesta Resultados: {data}")
-    return data
+    raw = _loads(resp.content)
+    if not isinstance(raw, dict):
+        raise RuntimeError(f"Respuesta no esperada de resultados: {raw}")
+
+    log.debug("Respuesta Resultados: %s", raw)
+    return raw
+
+
+def _normalizar_resultados(raw: dict) -> dict:
+    """
+    Copia de la respuesta de /resultados con las claves de primer nivel en
+    minúscula ("tipo", "mensaje") para hacer una sola búsqueda por clave.
+    El original no se toca: es el que se guarda en respuesta_bruta.
+    """
+    return {k.lower(): v for k, v in raw.items()}
+
+
+def _mensaje_de(data: dict) -> Any:
+    """
+    'mensaje' de una respuesta de Hércules. Busca primero la clave en
+    minúscula (la de _normalizar_resultados, una sola búsqueda en el camino
+    normal) y luego "Mensaje" para datos que no pasaron por ahí.
+    """
+    return data.get("mensaje") or data.get("Mensaje") or ""
 
 
 def es_respuesta_exitosa_hercules(data: dict) -> bool:
@@ -619,6 +1149,8 @@ def es_respuesta_exitosa_hercules(data: dict) -> bool:
     Determina si la respuesta de Hércules es considerada "exitosa"
     para efectos de COBRO de créditos.
 
+    Recibe el dict ya normalizado por _normalizar_resultados (claves en minúscula).
+
     Criterio:
       - Tipo == 0 (aceptando 0 o "0")
       - Mensaje no vacío
@@ -627,113 +1159,297 @@ def es_respuesta_exitosa_hercules(data: dict) -> bool:
       - En cualquier otro caso con Tipo == 0 -> éxito.
     """
     try:
-        if isinstance(data, str):
-            data = json.loads(data)
-
-        if not isinstance(data, dict):
-            print(f"[DEBUG] es_respuesta_exitosa_hercules: data no es dict: {type(data)}")
-            return False
-
         # 1) Validar Tipo == 0
-        tipo = data.get("Tipo")
-        if tipo is None:
-            tipo = data.get("tipo")
-
+        tipo = data.get("tipo")
         if str(tipo) != "0":
-            print(f"[DEBUG] es_respuesta_exitosa_hercules: Tipo != 0 -> {tipo}")
+            log.debug("es_respuesta_exitosa_hercules: Tipo != 0 -> %s", tipo)
             return False
 
         # 2) Extraer Mensaje
-        mensaje_raw = data.get("Mensaje") or data.get("mensaje")
+        mensaje_raw = data.get("mensaje")
         if not mensaje_raw:
-            print("[DEBUG] es_respuesta_exitosa_hercules: Mensaje vacío")
+            log.debug("es_respuesta_exitosa_hercules: Mensaje vacío")
             return False
 
         if isinstance(mensaje_raw, str):
             try:
-                mensaje_json = json.loads(mensaje_raw)
+                mensaje_json = _loads(mensaje_raw)
             except Exception:
                 # No se pudo parsear, pero hay contenido y Tipo == 0 -> éxito
-                print("[DEBUG] es_respuesta_exitosa_hercules: no se pudo parsear Mensaje, pero hay contenido.")
+                log.debug("es_respuesta_exitosa_hercules: no se pudo parsear Mensaje, pero hay contenido.")
                 return True
         elif isinstance(mensaje_raw, dict):
             mensaje_json = mensaje_raw
         else:
-            print(f"[DEBUG] es_respuesta_exitosa_hercules: Mensaje tipo {type(mensaje_raw)}, lo aceptamos.")
+            log.debug("es_respuesta_exitosa_hercules: Mensaje tipo %s, lo aceptamos.", type(mensaje_raw))
             return True
 
         # 3) Revisar banderas de error
         if isinstance(mensaje_json, dict):
             # Error explícito en mayúscula
             if mensaje_json.get("Error") is True:
-                print("[DEBUG] es_respuesta_exitosa_hercules: Error == True en mensaje_json")
+                log.debug("es_respuesta_exitosa_hercules: Error == True en mensaje_json")
                 return False
 
             # codigoResultado distinto de EXITOSO
             codigo = mensaje_json.get("codigoResultado") or mensaje_json.get("codigo")
             if codigo and str(codigo).upper() != "EXITOSO":
-                print(f"[DEBUG] es_respuesta_exitosa_hercules: codigoResultado != EXITOSO -> {codigo}")
+                log.debug("es_respuesta_exitosa_hercules: codigoResultado != EXITOSO -> %s", codigo)
                 return False
 
             # error en minúscula con texto tipo "Vehiculo no encontrado"
             err_text = mensaje_json.get("error")
             if isinstance(err_text, str) and "no encontrado" in err_text.lower():
-                print(f"[DEBUG] es_respuesta_exitosa_hercules: error de 'no encontrado' -> {err_text}")
+                log.debug("es_respuesta_exitosa_hercules: error de 'no encontrado' -> %s", err_text)
                 return False
 
         # 4) Si llegamos aquí, consideramos éxito
         return True
 
-    except Exception as e:
-        print(f"[ERROR] Analizando respuesta de Hércules: {e}")
+    except Exception:
+        log.exception("Analizando respuesta de Hércules")
         return False
 
 # =====================================================================
 # 9. GENERACIÓN DE INFORME VEHICULAR (PDF B7 v2)
 # =====================================================================
 
-def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/QuantumFBot") -> bytes:
+@lru_cache(maxsize=1024)
+def _qr_png_bytes(payload: str) -> bytes:
+    """
+    PNG del QR para un payload dado. Es determinista, así que se cachea:
+    repetir el mismo qr_url no vuelve a calcular la matriz ni a codificar el PNG.
     """
-    Genera el informe vehicular en PDF (plantilla B7 v2) en memoria
-    y devuelve los bytes del archivo.
+    qr_obj = qrcode.QRCode(box_size=8, border=1)
+    qr_obj.add_data(payload)
+    qr_obj.make(fit=True)
+    img = qr_obj.make_image(fill_color="black", back_color="white")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# El QR por defecto (enlace al bot) se codifica al importar: el primer
+# informe no paga el coste de qrcode/PIL.
+QR_URL_DEFECTO = "https://t.me/QuantumFBot"
+_qr_png_bytes(QR_URL_DEFECTO)
+
+
+# Colores del informe, parseados una sola vez al importar
+COLOR_AZUL = colors.HexColor("#003366")       # títulos y textos de cabecera
+COLOR_GRIS_TEXTO = colors.HexColor("#555555")  # subtítulo del encabezado
+COLOR_GRID = colors.HexColor("#CCCCCC")       # rejilla de tablas
+COLOR_BANDA = colors.HexColor("#DDDDDD")      # bandas de sección
+COLOR_CABECERA = colors.HexColor("#EEEEEE")   # fila de cabecera de tablas
+COLOR_ETIQUETA = colors.HexColor("#F5F5F5")   # columna/fila de etiquetas
+
+# Estilos del informe, creados una vez. Son de solo lectura: derivar con
+# ParagraphStyle(parent=...) en lugar de mutarlos, se comparten entre hilos.
+_ESTILOS_BASE = getSampleStyleSheet()
+
+ESTILO_TITULO_SECCION = ParagraphStyle(
+    name="SectionTitle",
+    parent=_ESTILOS_BASE["Heading2"],
+    fontName="Helvetica-Bold",
+    fontSize=12,
+    textColor=COLOR_AZUL,
+    spaceBefore=6,
+    spaceAfter=4,
+)
+ESTILO_NORMAL = ParagraphStyle(
+    name="Normal9",
+    parent=_ESTILOS_BASE["Normal"],
+    fontSize=9,
+)
+ESTILO_PEQUENO = ParagraphStyle(
+    name="Small",
+    parent=_ESTILOS_BASE["Normal"],
+    fontSize=8,
+)
+
+
+# Estilos de tabla recurrentes del informe (TableStyle no se modifica al aplicarse)
+TABLA_ESTILO_CABECERA = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, 0), COLOR_CABECERA),
+        ("TEXTCOLOR", (0, 0), (-1, 0), COLOR_AZUL),
+        ("GRID", (0, 0), (-1, -1), 0.25, COLOR_GRID),
+    ]
+)
+TABLA_ESTILO_ETIQUETAS = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (0, -1), COLOR_ETIQUETA),
+        ("TEXTCOLOR", (0, 0), (0, -1), COLOR_AZUL),
+        ("GRID", (0, 0), (-1, -1), 0.25, COLOR_GRID),
+    ]
+)
+TABLA_ESTILO_BANDA = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, -1), COLOR_BANDA),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("BOX", (0, 0), (-1, -1), 0.5, colors.black),
+    ]
+)
+TABLA_ESTILO_DETALLE = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, 0), COLOR_ETIQUETA),
+        ("TEXTCOLOR", (0, 0), (-1, 0), COLOR_AZUL),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.black),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ]
+)
 
-    Soporta que 'Mensaje' venga como string JSON o como dict ya deserializado.
+
+@lru_cache(maxsize=256)
+def _etiqueta_base(texto: str, pequena: bool) -> Paragraph:
+    return Paragraph(texto, ESTILO_PEQUENO if pequena else ESTILO_NORMAL)
+
+
+def _etiqueta(texto: str, pequena: bool = False) -> Paragraph:
+    """
+    Paragraph para un texto fijo del informe (etiquetas y cabeceras).
+    El marcado se parsea una sola vez; cada uso recibe una copia superficial
+    porque wrap()/split() guardan estado en la instancia y los informes se
+    generan en hilos concurrentes.
     """
-    mensaje_raw = data.get("Mensaje") or data.get("mensaje") or ""
+    return copy.copy(_etiqueta_base(texto, pequena))
+
+
+def _cell(t, _estilo=ESTILO_NORMAL) -> Paragraph:
+    """Celda con un valor dinámico del informe ('-' si viene None)."""
+    if type(t) is str:
+        return Paragraph(t, _estilo)
+    if t is None:
+        return _etiqueta("-")
+    return Paragraph(str(t), _estilo)
+
+
+def _cell_small(t, _estilo=ESTILO_PEQUENO) -> Paragraph:
+    if type(t) is str:
+        return Paragraph(t, _estilo)
+    if t is None:
+        return _etiqueta("-", pequena=True)
+    return Paragraph(str(t), _estilo)
+
+
+# Claves alternativas con las que llegan los mismos datos según el servicio
+_CAMPOS_NOMBRE = ("nombre1", "nombre2", "apellido1", "apellido2")
+_CLAVES_TIPO_DOC = ("idTipoDoc", "tipoDocumento", "tipoDoc")
+_CLAVES_NRO_DOC = ("nroDocumento", "numeroDocumento", "nroDoc")
+_CLAVES_TIPO_DOC_EMPRESA = ("tipoDocumentoEmpresa", "tipoDocumentoId")
+_CLAVES_NRO_DOC_EMPRESA = ("numeroDocumentoEmpresa", "nroDocumento")
+
+
+def _primer_valor(d: dict, claves: Tuple[str, ...], defecto: str = "-") -> Any:
+    """Primer valor no vacío de d entre las claves dadas; si no hay, el defecto."""
+    for k in claves:
+        v = d.get(k)
+        if v:
+            return v
+    return defecto
+
+
+def _nombre_completo(person: dict) -> str:
+    """Une nombres y apellidos omitiendo los vacíos (sin dobles espacios)."""
+    return " ".join(filter(None, (person.get(k) for k in _CAMPOS_NOMBRE)))
+
+
+@lru_cache(maxsize=4096)
+def _parse_fecha_dmy(fecha_str: str, formato: str = "%d/%m/%Y") -> date:
+    """
+    Convierte 'dd/mm/aaaa' a date cortando la cadena (sin strptime).
+    También acepta fechas ISO ('aaaa-mm-dd', con o sin hora), que a veces
+    llegan en fechaVigencia/fechaVencimiento. Cualquier otra forma cae a
+    strptime con el formato dado; lanza ValueError si no es una fecha válida.
+
+    Cacheada: cada fecha de SOAT/RTM se evalúa dos veces por informe (resumen
+    y tabla de detalle) y se repite entre consultas del mismo vehículo.
+    """
+    if len(fecha_str) == 10 and fecha_str[2] == "/" and fecha_str[5] == "/":
+        return date(int(fecha_str[6:10]), int(fecha_str[3:5]), int(fecha_str[0:2]))
+    if len(fecha_str) >= 10 and fecha_str[4] == "-" and fecha_str[7] == "-":
+        return date.fromisoformat(fecha_str[:10])
+    return datetime.strptime(fecha_str, formato).date()
+
+
+@dataclass(frozen=True)
+class ModeloInforme:
+    """Bloques del payload de Hércules que alimentan el informe vehicular."""
+    datos_vehiculo: dict
+    adicional: dict
+    person: dict
+    datos_empresa: dict
+    dir_empresa: dict
+    ubic: dict
+
+
+def extraer_modelo_informe(data: dict) -> ModeloInforme:
+    """
+    Decodifica 'Mensaje' (string JSON o dict ya deserializado) y normaliza sus
+    dos estructuras posibles. Función pura: no toca ReportLab.
+    """
+    mensaje_raw = _mensaje_de(data)
 
-    # --- NUEVO: soportar string o dict en Mensaje ---
     info = {}
     if isinstance(mensaje_raw, str):
         try:
-            info = json.loads(mensaje_raw)
+            info = _loads(mensaje_raw)
         except Exception as e:
-            print(f"[ERROR] generar_informe_vehicular_B7_v2: no se pudo json.loads(Mensaje): {e}")
+            log.error("extraer_modelo_informe: no se pudo decodificar Mensaje: %s", e)
             info = {}
     elif isinstance(mensaje_raw, dict):
         info = mensaje_raw
     else:
-        print(f"[WARN] generar_informe_vehicular_B7_v2: Mensaje es tipo inesperado: {type(mensaje_raw)}")
+        log.warning("extraer_modelo_informe: Mensaje es tipo inesperado: %s", type(mensaje_raw))
+    if not isinstance(info, dict):
         info = {}
 
     # Soportar dos estructuras:
     # 1) {"vehiculo": {"datos":..., "adicional":...}, "persona": {...}}
     # 2) {"datos":..., "adicional":...} (solo vehículo)
     vehiculo_info = info.get("vehiculo") or {}
-    if not vehiculo_info and isinstance(info, dict) and "datos" in info:
+    if not vehiculo_info and "datos" in info:
         vehiculo_info = {
             "datos": info.get("datos") or {},
             "adicional": info.get("adicional") or {},
         }
 
-    datos_vehiculo = vehiculo_info.get("datos", {}) or {}
-    adicional = vehiculo_info.get("adicional", {}) or {}
-
     persona_info = info.get("persona", {}) or {}
-    person = persona_info.get("person", {}) or {}
-    datos_empresa = persona_info.get("datosEmpresa") or {}
-    dir_empresa = persona_info.get("direccion") or {}
     ubic_list = persona_info.get("ubicabilidad") or []
-    ubic = ubic_list[0] if ubic_list else {}
+
+    return ModeloInforme(
+        datos_vehiculo=vehiculo_info.get("datos", {}) or {},
+        adicional=vehiculo_info.get("adicional", {}) or {},
+        person=persona_info.get("person", {}) or {},
+        datos_empresa=persona_info.get("datosEmpresa") or {},
+        dir_empresa=persona_info.get("direccion") or {},
+        ubic=ubic_list[0] if ubic_list else {},
+    )
+
+
+def generar_informe_vehicular_B7_v2(
+    data: dict,
+    qr_url: str = QR_URL_DEFECTO,
+    out: Optional[BinaryIO] = None,
+    informe: Optional[ModeloInforme] = None,
+) -> Optional[bytes]:
+    """
+    Genera el informe vehicular en PDF (plantilla B7 v2).
+
+    Si se pasa 'out' (archivo o BytesIO) el PDF se escribe directamente ahí y
+    se devuelve None; si no, se genera en memoria y se devuelven los bytes.
+    Si el llamador ya extrajo el modelo (extraer_modelo_informe) puede pasarlo
+    en 'informe' para no decodificar 'Mensaje' otra vez.
+    """
+    if informe is None:
+        informe = extraer_modelo_informe(data)
+
+    datos_vehiculo = informe.datos_vehiculo
+    adicional = informe.adicional
+    person = informe.person
+    datos_empresa = informe.datos_empresa
+    dir_empresa = informe.dir_empresa
+    ubic = informe.ubic
 
     # ==========================
     # 1. Datos vehículo
@@ -791,29 +1507,14 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
     # ==========================
     # Persona natural
     if person:
-        nombre_prop = " ".join(
-            [
-                person.get("nombre1", ""),
-                person.get("nombre2", ""),
-                person.get("apellido1", ""),
-                person.get("apellido2", ""),
-            ]
-        ).strip() or "-"
-        prop_tipo_doc = person.get("idTipoDoc") or person.get("tipoDocumento") or "-"
-        prop_num_doc = person.get("nroDocumento") or person.get("numeroDocumento") or "-"
+        nombre_prop = _nombre_completo(person) or "-"
+        prop_tipo_doc = _primer_valor(person, _CLAVES_TIPO_DOC, "-")
+        prop_num_doc = _primer_valor(person, _CLAVES_NRO_DOC, "-")
     # Persona jurídica (empresa)
     elif datos_empresa:
         nombre_prop = datos_empresa.get("razonSocial") or "-"
-        prop_tipo_doc = (
-            datos_empresa.get("tipoDocumentoEmpresa")
-            or datos_empresa.get("tipoDocumentoId")
-            or "NIT"
-        )
-        prop_num_doc = (
-            datos_empresa.get("numeroDocumentoEmpresa")
-            or datos_empresa.get("nroDocumento")
-            or "-"
-        )
+        prop_tipo_doc = _primer_valor(datos_empresa, _CLAVES_TIPO_DOC_EMPRESA, "NIT")
+        prop_num_doc = _primer_valor(datos_empresa, _CLAVES_NRO_DOC_EMPRESA, "-")
     else:
         nombre_prop = "-"
         prop_tipo_doc = "-"
@@ -876,28 +1577,29 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
     # ==========================
     # 4. SOAT y RTM
     # ==========================
-    lista_polizas = adicional.get("listaPolizas") or []
-    soat_list = [
-        p for p in lista_polizas
-        if (p.get("tipoPoliza", "") or "").upper() == "SOAT"
-    ]
+    # Un solo instante por informe: vigencias y fecha de emisión coinciden
+    ahora = datetime.now()
+    hoy = ahora.date()
 
     def calcular_vigente(fecha_str, formato="%d/%m/%Y"):
         try:
-            fecha = datetime.strptime(fecha_str, formato).date()
-            hoy = datetime.now().date()
-            return "SI" if fecha >= hoy else "NO"
+            return "SI" if _parse_fecha_dmy(fecha_str, formato) >= hoy else "NO"
         except Exception:
             return "-"
 
-    soat_vigente = "SI" if any(
-        calcular_vigente(p.get("fechaVencimiento", "")) == "SI" for p in soat_list
-    ) else "NO"
+    # Una sola pasada por las pólizas: filtra SOAT y evalúa su vigencia (que
+    # sirve tanto para el resumen como para las filas de detalle)
+    soat_list = []
+    soat_vigencias = []
+    for p in adicional.get("listaPolizas") or []:
+        if (p.get("tipoPoliza", "") or "").upper() == "SOAT":
+            soat_list.append(p)
+            soat_vigencias.append(calcular_vigente(p.get("fechaVencimiento", "")))
+    soat_vigente = "SI" if "SI" in soat_vigencias else "NO"
 
     rtm_list = adicional.get("listaRtm") or []
-    rtm_vigente = "SI" if any(
-        calcular_vigente(r.get("fechaVigencia", "")) == "SI" for r in rtm_list
-    ) else "NO"
+    rtm_vigencias = [calcular_vigente(r.get("fechaVigencia", "")) for r in rtm_list]
+    rtm_vigente = "SI" if "SI" in rtm_vigencias else "NO"
 
     inscrito_runt = datos_vehiculo.get("vehiculoInscritoRUNT", "-")
     gravamenes = datos_vehiculo.get("poseeGravamenes", "-")
@@ -912,46 +1614,37 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
     # ==========================
     # 5. Estilos ReportLab
     # ==========================
-    styles = getSampleStyleSheet()
-
-    section_title_style = ParagraphStyle(
-        name="SectionTitle",
-        parent=styles["Heading2"],
-        fontName="Helvetica-Bold",
-        fontSize=12,
-        textColor=colors.HexColor("#003366"),
-        spaceBefore=6,
-        spaceAfter=4,
-    )
-    normal_style = styles["Normal"]
-    normal_style.fontSize = 9
-
-    small_style = ParagraphStyle(
-        name="Small",
-        parent=styles["Normal"],
-        fontSize=8,
-    )
-
-    def cell(t):
-        return Paragraph(str(t if t is not None else "-"), normal_style)
-
-    def cell_small(t):
-        return Paragraph(str(t if t is not None else "-"), small_style)
+    section_title_style = ESTILO_TITULO_SECCION
+    normal_style = ESTILO_NORMAL
+
+    def tabla_campos(filas):
+        """
+        Tabla de 4 columnas a partir de tuplas (etiqueta, valor, etiqueta, valor).
+        Un valor que ya es Paragraph (p. ej. _cell_small) se usa tal cual.
+        """
+        return Table(
+            [
+                [
+                    _etiqueta(e1),
+                    v1 if isinstance(v1, Paragraph) else _cell(v1),
+                    _etiqueta(e2),
+                    v2 if isinstance(v2, Paragraph) else _cell(v2),
+                ]
+                for e1, v1, e2, v2 in filas
+            ],
+            colWidths=[doc.width / 4] * 4,
+            style=TABLA_ESTILO_CABECERA,
+        )
 
     # ==========================
-    # 6. QR en imagen temporal
+    # 6. QR en memoria (sin archivo temporal)
     # ==========================
-    qr_path = "qr_temp_informe_vehicular.png"
-    qr_obj = qrcode.QRCode(box_size=8, border=1)
-    qr_obj.add_data(qr_url)
-    qr_obj.make(fit=True)
-    img = qr_obj.make_image(fill_color="black", back_color="white")
-    img.save(qr_path)
+    qr_img = ImageReader(io.BytesIO(_qr_png_bytes(qr_url)))
 
     # ==========================
-    # 7. Construir PDF en memoria
+    # 7. Construir PDF (en 'out' o en memoria)
     # ==========================
-    buffer = io.BytesIO()
+    buffer = out if out is not None else io.BytesIO()
     doc = SimpleDocTemplate(
         buffer,
         pagesize=A4,
@@ -965,21 +1658,11 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
 
     # ---------- 1. Datos principales ----------
     story.append(Paragraph("1. Datos principales del vehículo", section_title_style))
-    tabla_datos_principales = Table(
+    tabla_datos_principales = tabla_campos(
         [
-            [cell("Placa"), cell(placa), cell("Clase"), cell(clase)],
-            [cell("Servicio"), cell(servicio), cell("Estado del registro"), cell(estado_registro)],
-        ],
-        colWidths=[total_width / 4] * 4,
-    )
-    tabla_datos_principales.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
+            ("Placa", placa, "Clase", clase),
+            ("Servicio", servicio, "Estado del registro", estado_registro),
+        ]
     )
     story.append(tabla_datos_principales)
     story.append(Spacer(1, 6))
@@ -989,40 +1672,22 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
 
     tabla_propietario = Table(
         [
-            [cell("Nombre / Razón social"), cell(nombre_prop)],
-            [cell("Tipo y número de documento"), cell(f"{prop_tipo_doc} {prop_num_doc}")],
+            [_etiqueta("Nombre / Razón social"), _cell(nombre_prop)],
+            [_etiqueta("Tipo y número de documento"), _cell(" ".join(x for x in (prop_tipo_doc, prop_num_doc) if x != "-") or "-")],
         ],
         colWidths=[total_width / 2, total_width / 2],
     )
-    tabla_propietario.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (0, -1), colors.HexColor("#F5F5F5")),
-                ("TEXTCOLOR", (0, 0), (0, -1), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
-    )
+    tabla_propietario.setStyle(TABLA_ESTILO_ETIQUETAS)
     story.append(tabla_propietario)
     story.append(Spacer(1, 4))
 
     # Dirección y correo con letra más pequeña
-    tabla_ubicacion = Table(
+    tabla_ubicacion = tabla_campos(
         [
-            [cell("Departamento"), cell(departamento), cell("Ciudad"), cell(ciudad)],
-            [cell("Dirección"), cell_small(direccion), cell("Teléfono"), cell(telefono)],
-            [cell("Correo"), cell_small(correo), cell(""), cell("")],
-        ],
-        colWidths=[total_width / 4] * 4,
-    )
-    tabla_ubicacion.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
+            ("Departamento", departamento, "Ciudad", ciudad),
+            ("Dirección", _cell_small(direccion), "Teléfono", telefono),
+            ("Correo", _cell_small(correo), "", ""),
+        ]
     )
     story.append(tabla_ubicacion)
     story.append(Spacer(1, 4))
@@ -1030,43 +1695,33 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
     # Licencias solo si existen
     if licencias_list:
         tabla_lic_title = Table(
-            [[Paragraph("<b>LICENCIAS DE CONDUCCIÓN</b>", normal_style)]],
+            [[_etiqueta("<b>LICENCIAS DE CONDUCCIÓN</b>")]],
             colWidths=[total_width],
         )
-        tabla_lic_title.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#DDDDDD")),
-                    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-                    ("BOX", (0, 0), (-1, -1), 0.5, colors.black),
-                ]
-            )
-        )
+        tabla_lic_title.setStyle(TABLA_ESTILO_BANDA)
         story.append(tabla_lic_title)
 
         lic_header = [
-            cell_small("No. licencia"),
-            cell_small("Categoría"),
-            cell_small("Fecha expedición"),
-            cell_small("Fecha vencimiento"),
-            cell_small("Estado"),
+            _etiqueta("No. licencia", pequena=True),
+            _etiqueta("Categoría", pequena=True),
+            _etiqueta("Fecha expedición", pequena=True),
+            _etiqueta("Fecha vencimiento", pequena=True),
+            _etiqueta("Estado", pequena=True),
         ]
         lic_rows = [lic_header]
         for lic in licencias_list:
             lic_rows.append(
                 [
-                    cell_small(lic["numero"]),
-                    cell_small(lic["categoria"]),
-                    cell_small(lic["fechaExpedicion"]),
-                    cell_small(lic["fechaVencimiento"]),
-                    cell_small(lic["estado"]),
+                    _cell_small(lic["numero"]),
+                    _cell_small(lic["categoria"]),
+                    _cell_small(lic["fechaExpedicion"]),
+                    _cell_small(lic["fechaVencimiento"]),
+                    _cell_small(lic["estado"]),
                 ]
             )
         tabla_lic = Table(
             lic_rows,
-            colWidths[
-                :
-            ] if False else [
+            colWidths=[
                 total_width * 0.18,
                 total_width * 0.12,
                 total_width * 0.20,
@@ -1074,109 +1729,71 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
                 total_width * 0.30,
             ],
         )
-        tabla_lic.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#F5F5F5")),
-                    ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                    ("GRID", (0, 0), (-1, -1), 0.25, colors.black),
-                    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                ]
-            )
-        )
+        tabla_lic.setStyle(TABLA_ESTILO_DETALLE)
         story.append(tabla_lic)
         story.append(Spacer(1, 6))
 
     # ---------- 3. Características del vehículo ----------
     story.append(Paragraph("3. Características del vehículo", section_title_style))
-    tabla_caracteristicas = Table(
+    tabla_caracteristicas = tabla_campos(
         [
-            [cell("Marca"), cell(marca), cell("Modelo"), cell(modelo)],
-            [cell("Línea"), cell(linea), cell("Clase"), cell(clase)],
-            [cell("Color"), cell(color), cell("Carrocería"), cell(carroceria)],
-            [cell("Cilindraje"), cell(cilindraje), cell("Tipo de combustible"), cell(tipo_combustible)],
-            [cell("Nro. Serie"), cell(nro_serie), cell("Nro. VIN"), cell(vin)],
-            [cell("Nro. Motor"), cell(numero_motor), cell("Nro. Chasis"), cell(numero_chasis)],
-            [cell("Importado"), cell(importado), cell("Radio acción"), cell(radio_accion)],
-            [cell("Nivel servicio"), cell(nivel_servicio), cell("Transmisión"), cell(transmision)],
-            [cell("Tracción"), cell(traccion), cell("Nivel de emisiones"), cell(nivel_emisiones)],
-            [cell("Estado del vehículo"), cell(estado_vehiculo), cell("Modalidad servicio"), cell(modalidad_servicio)],
-            [cell("Regrabación motor"), cell(regrab_motor), cell("Regrabación chasis"), cell(regrab_chasis)],
-            [cell("Regrabación serie"), cell(regrab_serie), cell("Regrabación VIN"), cell(regrab_vin)],
-            [cell("Tiene gravamen"), cell(tiene_gravamen), cell("Vehículo rematado"), cell(vehiculo_rematado)],
-            [cell("Tiene medidas cautelares"), cell(medidas_cautelares), cell(""), cell("")],
-        ],
-        colWidths=[total_width / 4] * 4,
-    )
-    tabla_caracteristicas.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
+            ("Marca", marca, "Modelo", modelo),
+            ("Línea", linea, "Clase", clase),
+            ("Color", color, "Carrocería", carroceria),
+            ("Cilindraje", cilindraje, "Tipo de combustible", tipo_combustible),
+            ("Nro. Serie", nro_serie, "Nro. VIN", vin),
+            ("Nro. Motor", numero_motor, "Nro. Chasis", numero_chasis),
+            ("Importado", importado, "Radio acción", radio_accion),
+            ("Nivel servicio", nivel_servicio, "Transmisión", transmision),
+            ("Tracción", traccion, "Nivel de emisiones", nivel_emisiones),
+            ("Estado del vehículo", estado_vehiculo, "Modalidad servicio", modalidad_servicio),
+            ("Regrabación motor", regrab_motor, "Regrabación chasis", regrab_chasis),
+            ("Regrabación serie", regrab_serie, "Regrabación VIN", regrab_vin),
+            ("Tiene gravamen", tiene_gravamen, "Vehículo rematado", vehiculo_rematado),
+            ("Tiene medidas cautelares", medidas_cautelares, "", ""),
+        ]
     )
     story.append(tabla_caracteristicas)
     story.append(Spacer(1, 6))
 
-    # ---------- Forzar sección 4 a nueva página ----------
-    story.append(PageBreak())
-
     # ---------- 4. Estado de documentos y seguridad ----------
-    story.append(Paragraph("4. Estado de documentos y seguridad", section_title_style))
-    tabla_docs_resumen = Table(
+    # Se mantiene unida: salta de página solo si no cabe en la actual
+    seccion4 = []
+    seccion4.append(Paragraph("4. Estado de documentos y seguridad", section_title_style))
+    tabla_docs_resumen = tabla_campos(
         [
-            [cell("Inscrito en RUNT"), cell(inscrito_runt), cell("Gravámenes"), cell(gravamenes)],
-            [cell("Tarjeta de servicios"), cell(tarjeta_servicios), cell("Vigencia tarjeta"), cell(tarjeta_vence)],
-            [cell("SOAT vigente"), cell(soat_vigente), cell("RTM vigente"), cell(rtm_vigente)],
-        ],
-        colWidths=[total_width / 4] * 4,
-    )
-    tabla_docs_resumen.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
+            ("Inscrito en RUNT", inscrito_runt, "Gravámenes", gravamenes),
+            ("Tarjeta de servicios", tarjeta_servicios, "Vigencia tarjeta", tarjeta_vence),
+            ("SOAT vigente", soat_vigente, "RTM vigente", rtm_vigente),
+        ]
     )
-    story.append(tabla_docs_resumen)
-    story.append(Spacer(1, 4))
+    seccion4.append(tabla_docs_resumen)
+    seccion4.append(Spacer(1, 4))
 
     if soat_list:
         tabla_soat_title = Table(
-            [[Paragraph("<b>SOAT</b>", normal_style)]],
+            [[_etiqueta("<b>SOAT</b>")]],
             colWidths=[total_width],
         )
-        tabla_soat_title.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#DDDDDD")),
-                    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-                    ("BOX", (0, 0), (-1, -1), 0.5, colors.black),
-                ]
-            )
-        )
-        story.append(tabla_soat_title)
+        tabla_soat_title.setStyle(TABLA_ESTILO_BANDA)
+        seccion4.append(tabla_soat_title)
 
         soat_header = [
-            cell_small("No. Póliza"),
-            cell_small("Fecha inicio vigencia"),
-            cell_small("Fecha fin vigencia"),
-            cell_small("Entidad que expide SOAT"),
-            cell_small("Vigente"),
+            _etiqueta("No. Póliza", pequena=True),
+            _etiqueta("Fecha inicio vigencia", pequena=True),
+            _etiqueta("Fecha fin vigencia", pequena=True),
+            _etiqueta("Entidad que expide SOAT", pequena=True),
+            _etiqueta("Vigente", pequena=True),
         ]
         soat_rows = [soat_header]
-        for pol in soat_list:
+        for pol, vigente in zip(soat_list, soat_vigencias):
             soat_rows.append(
                 [
-                    cell_small(pol.get("numeroPoliza", "-")),
-                    cell_small(pol.get("fechaInicio", "-")),
-                    cell_small(pol.get("fechaVencimiento", "-")),
-                    cell_small(pol.get("aseguradora", "-")),
-                    cell_small(calcular_vigente(pol.get("fechaVencimiento", "-"))),
+                    _cell_small(pol.get("numeroPoliza", "-")),
+                    _cell_small(pol.get("fechaInicio", "-")),
+                    _cell_small(pol.get("fechaVencimiento", "-")),
+                    _cell_small(pol.get("aseguradora", "-")),
+                    _cell_small(vigente),
                 ]
             )
         tabla_soat = Table(
@@ -1189,51 +1806,34 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
                 total_width * 0.15,
             ],
         )
-        tabla_soat.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#F5F5F5")),
-                    ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                    ("GRID", (0, 0), (-1, -1), 0.25, colors.black),
-                    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                ]
-            )
-        )
-        story.append(tabla_soat)
-        story.append(Spacer(1, 4))
+        tabla_soat.setStyle(TABLA_ESTILO_DETALLE)
+        seccion4.append(tabla_soat)
+        seccion4.append(Spacer(1, 4))
 
     if rtm_list:
         tabla_rtm_title = Table(
-            [[Paragraph("<b>REVISIÓN TÉCNICO MECÁNICA</b>", normal_style)]],
+            [[_etiqueta("<b>REVISIÓN TÉCNICO MECÁNICA</b>")]],
             colWidths=[total_width],
         )
-        tabla_rtm_title.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#DDDDDD")),
-                    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-                    ("BOX", (0, 0), (-1, -1), 0.5, colors.black),
-                ]
-            )
-        )
-        story.append(tabla_rtm_title)
+        tabla_rtm_title.setStyle(TABLA_ESTILO_BANDA)
+        seccion4.append(tabla_rtm_title)
 
         rtm_header = [
-            cell_small("Tipo de revisión"),
-            cell_small("Fecha expedición"),
-            cell_small("Fecha vigencia"),
-            cell_small("CDA expide RTM"),
-            cell_small("Vigente"),
+            _etiqueta("Tipo de revisión", pequena=True),
+            _etiqueta("Fecha expedición", pequena=True),
+            _etiqueta("Fecha vigencia", pequena=True),
+            _etiqueta("CDA expide RTM", pequena=True),
+            _etiqueta("Vigente", pequena=True),
         ]
         rtm_rows = [rtm_header]
-        for r in rtm_list:
+        for r, vigente in zip(rtm_list, rtm_vigencias):
             rtm_rows.append(
                 [
-                    cell_small(r.get("tipoRevision", "-")),
-                    cell_small(r.get("fechaExpedicion", "-")),
-                    cell_small(r.get("fechaVigencia", "-")),
-                    cell_small(r.get("nombreCda", "-")),
-                    cell_small(calcular_vigente(r.get("fechaVigencia", "-"))),
+                    _cell_small(r.get("tipoRevision", "-")),
+                    _cell_small(r.get("fechaExpedicion", "-")),
+                    _cell_small(r.get("fechaVigencia", "-")),
+                    _cell_small(r.get("nombreCda", "-")),
+                    _cell_small(vigente),
                 ]
             )
         tabla_rtm = Table(
@@ -1246,51 +1846,38 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
                 total_width * 0.15,
             ],
         )
-        tabla_rtm.setStyle(
-            TableStyle(
-                [
-                    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#F5F5F5")),
-                    ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#003366")),
-                    ("GRID", (0, 0), (-1, -1), 0.25, colors.black),
-                    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                ]
-            )
-        )
-        story.append(tabla_rtm)
-        story.append(Spacer(1, 6))
+        tabla_rtm.setStyle(TABLA_ESTILO_DETALLE)
+        seccion4.append(tabla_rtm)
+        seccion4.append(Spacer(1, 6))
+
+    story.append(KeepTogether(seccion4))
 
     # ---------- 5. Información adicional ----------
     story.append(Paragraph("5. Información adicional del vehículo", section_title_style))
     tabla_extra = Table(
         [
-            [cell("Aspiración"), cell(aspiracion)],
-            [cell("Tipo de freno"), cell(freno)],
-            [cell("Blindado"), cell(blindado)],
+            [_etiqueta("Aspiración"), _cell(aspiracion)],
+            [_etiqueta("Tipo de freno"), _cell(freno)],
+            [_etiqueta("Blindado"), _cell(blindado)],
         ],
         colWidths=[total_width / 3, total_width * 2 / 3],
     )
-    tabla_extra.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (0, -1), colors.HexColor("#F5F5F5")),
-                ("TEXTCOLOR", (0, 0), (0, -1), colors.HexColor("#003366")),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CCCCCC")),
-            ]
-        )
-    )
+    tabla_extra.setStyle(TABLA_ESTILO_ETIQUETAS)
     story.append(tabla_extra)
     story.append(Spacer(1, 10))
 
     disclaimer = Paragraph(
         "<font size='7' color='#555555'>Este informe es generado por un sistema interno de consultas "
         "y no sustituye documentos oficiales de tránsito ni certificados expedidos por autoridades competentes.</font>",
-        styles["Normal"],
+        normal_style,
     )
     story.append(disclaimer)
 
     # ==========================
     # 8. Encabezado y pie
     # ==========================
+    fecha_text = f"Fecha de emisión: {ahora.strftime('%Y-%m-%d %H:%M')}"
+
     def draw_header_and_footer(canvas, doc_obj):
         canvas.saveState()
         page_width, page_height = doc_obj.pagesize
@@ -1303,14 +1890,13 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
         date_y = subtitle_y - 3 * mm
 
         canvas.setFont("Helvetica-Bold", 18)
-        canvas.setFillColor(colors.HexColor("#003366"))
+        canvas.setFillColor(COLOR_AZUL)
         canvas.drawString(left, title_y, "INFORME VEHICULAR")
 
         canvas.setFont("Helvetica", 9)
-        canvas.setFillColor(colors.HexColor("#555555"))
+        canvas.setFillColor(COLOR_GRIS_TEXTO)
         canvas.drawString(left, subtitle_y, "Reporte generado por sistema de consultas Hércules")
 
-        fecha_text = f"Fecha de emisión: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
         canvas.setFont("Helvetica", 8)
         text_width = canvas.stringWidth(fecha_text, "Helvetica", 8)
         canvas.drawString(page_width - doc_obj.rightMargin - text_width, date_y, fecha_text)
@@ -1318,9 +1904,9 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
         qr_size = 30 * mm
         qr_x = page_width - doc_obj.rightMargin - qr_size
         qr_y = frame_top + 5 * mm
-        canvas.drawImage(qr_path, qr_x, qr_y, qr_size, qr_size, preserveAspectRatio=True, mask="auto")
+        canvas.drawImage(qr_img, qr_x, qr_y, qr_size, qr_size, preserveAspectRatio=True, mask="auto")
 
-        canvas.setStrokeColor(colors.HexColor("#003366"))
+        canvas.setStrokeColor(COLOR_AZUL)
         canvas.setLineWidth(1)
         canvas.line(doc_obj.leftMargin, frame_top, page_width - doc_obj.rightMargin, frame_top)
 
@@ -1333,6 +1919,9 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
 
     doc.build(story, onFirstPage=draw_header_and_footer, onLaterPages=draw_header_and_footer)
 
+    if out is not None:
+        return None
+
     pdf_bytes = buffer.getvalue()
     buffer.close()
     return pdf_bytes
@@ -1341,6 +1930,118 @@ def generar_informe_vehicular_B7_v2(data: dict, qr_url: str = "https://t.me/Quan
 # 10. FORMATEADORES DE RESPUESTA (TEXTO TELEGRAM)
 # =====================================================================
 
+# Caracteres con significado en parse_mode="Markdown" de Telegram. Los valores
+# que vienen de la API se escapan para que un "_" o "*" en un nombre no rompa
+# el mensaje (Telegram responde 400 "can't parse entities").
+_MD_ESPECIALES = re.compile(r"([_*`\[])")
+
+
+def _md(valor: Any) -> str:
+    """
+    Texto de valor con los caracteres especiales de Markdown escapados.
+    Solo para valores fuera de entidades: dentro de *negrita* o `código` el
+    Markdown clásico no admite escapes y la barra se vería literal.
+    """
+    return _MD_ESPECIALES.sub(r"\\\1", str(valor))
+
+
+# Dentro de una entidad el texto es literal salvo el carácter que la cierra;
+# se quitan "*" y "`" de los valores que van dentro de *...* o `...`
+_MD_CIERRE_ENTIDAD = str.maketrans("", "", "*`")
+
+
+def _md_en_entidad(valor: Any) -> str:
+    """Valor para insertar dentro de *negrita* o `código` (sin escapes)."""
+    return str(valor).translate(_MD_CIERRE_ENTIDAD)
+
+
+# Campos del vehículo en el texto de Telegram: nombre -> claves candidatas
+# del payload, en orden de preferencia (la primera con valor gana).
+_CLAVES_PLACA = ("placaNumeroUnicoIdentificacion", "placa")
+_CAMPOS_VEHICULO = (
+    ("placa", _CLAVES_PLACA),
+    ("clase", ("claseVehiculo",)),
+    ("marca", ("marcaVehiculo",)),
+    ("linea", ("lineaVehiculo",)),
+    ("modelo", ("modelo",)),
+    ("color", ("color",)),
+    ("carroceria", ("carroceria",)),
+    ("cilindraje", ("cilindraje",)),
+    ("servicio", ("servicio",)),
+    ("estado_registro", ("estadoRegistroVehiculo",)),
+    ("numero_motor", ("numeroMotor",)),
+    ("numero_chasis", ("numeroChasis",)),
+    ("vin", ("vin",)),
+    ("tipo_combustible", ("tipoCombustible", "combustible", "tipoCombustibleVehiculo")),
+)
+
+
+# Texto del informe vehicular para Telegram. Los bloques opcionales se
+# insertan ya formateados (o vacíos) en sus huecos.
+_PLANTILLA_VEHICULO = (
+    "🚗 *Informe vehicular – {placa}*\n"
+    "\n"
+    "*1. Datos principales del vehículo*\n"
+    "• Placa: `{placa}`\n"
+    "• Clase: {clase}\n"
+    "• Servicio: {servicio}\n"
+    "• Estado del registro: {estado_registro}\n"
+    "\n"
+    "*2. Características del vehículo*\n"
+    "• Marca: {marca}\n"
+    "• Línea: {linea}\n"
+    "• Modelo: {modelo}\n"
+    "• Color: {color}\n"
+    "• Carrocería: {carroceria}\n"
+    "• Cilindraje: {cilindraje}\n"
+    "• Tipo de combustible: {tipo_combustible}\n"
+    "• Nro. Motor: {numero_motor}\n"
+    "• Nro. Chasis: {numero_chasis}\n"
+    "• Nro. VIN: {vin}\n"
+    "\n"
+    "*3. Estado de documentos y seguridad*\n"
+    "• Inscrito en RUNT: {inscrito_runt}\n"
+    "• Posee gravámenes: {gravamenes}\n"
+    "• SOAT vigente: {soat_vigente}\n"
+    "{detalle_soat}"
+    "• RTM vigente: {rtm_vigente}\n"
+    "{detalle_rtm}"
+    "\n"
+    "{propietario}"
+    "*5. Información adicional*\n"
+    "• Blindado: {blindado}\n"
+    "• Accidentes reportados: {accidentes_count}"
+    "{licencias}"
+)
+_PLANTILLA_VEHICULO_SOAT = (
+    "• Detalle de la última póliza SOAT:\n"
+    "  ─ Número de póliza: {numero}\n"
+    "  ─ Entidad aseguradora: {aseguradora}\n"
+    "  ─ Fecha inicio vigencia: {inicio}\n"
+    "  ─ Fecha fin vigencia: {fin}\n"
+)
+_PLANTILLA_VEHICULO_RTM = (
+    "• Detalle de la última revisión técnico-mecánica:\n"
+    "  ─ Tipo de revisión: {tipo}\n"
+    "  ─ CDA: {cda}\n"
+    "  ─ Fecha expedición: {expedicion}\n"
+    "  ─ Fecha vigencia: {vigencia}\n"
+)
+_PLANTILLA_VEHICULO_PROPIETARIO = (
+    "*4. Propietario*\n"
+    "• Nombre / Razón social: {nombre}\n"
+    "• Tipo de documento: {tipo_doc}\n"
+    "• Número de documento: {nro_doc}\n"
+    "\n"
+)
+_PLANTILLA_VEHICULO_LICENCIA = (
+    "\n  ─ Licencia #{idx}:"
+    "\n    • Número de licencia: {numero}"
+    "\n    • Categoría: {categoria}"
+    "\n    • Estado: {estado}"
+)
+
+
 def formatear_respuesta_firma(data: dict):
     """
     Formatea la respuesta de consulta de firma.
@@ -1359,16 +2060,16 @@ def formatear_respuesta_firma(data: dict):
       - (texto, firma_b64) -> si encuentra la firma en base64.
     """
     try:
-        mensaje_raw = data.get("Mensaje") or data.get("mensaje") or ""
-        print(f"[DEBUG] formatear_respuesta_firma.mensaje_raw (tipo={type(mensaje_raw)}): {mensaje_raw}")
+        mensaje_raw = _mensaje_de(data)
+        log.debug("formatear_respuesta_firma.mensaje_raw (tipo=%s): %s", type(mensaje_raw), mensaje_raw)
 
         # 1) Normalizar a dict
         info = {}
         if isinstance(mensaje_raw, str):
             try:
-                info = json.loads(mensaje_raw)
+                info = _loads(mensaje_raw)
             except Exception as e:
-                print(f"[ERROR] formatear_respuesta_firma: no se pudo json.loads(mensaje_raw): {e}")
+                log.error("formatear_respuesta_firma: no se pudo decodificar mensaje_raw: %s", e)
                 # Devolvemos texto crudo
                 texto = (
                     "📝 *Resultado de consulta de firma (sin formato JSON)*\n\n"
@@ -1378,28 +2079,21 @@ def formatear_respuesta_firma(data: dict):
         elif isinstance(mensaje_raw, dict):
             info = mensaje_raw
         else:
-            print(f"[DEBUG] formatear_respuesta_firma: mensaje_raw tipo inesperado: {type(mensaje_raw)}")
+            log.debug("formatear_respuesta_firma: mensaje_raw tipo inesperado: %s", type(mensaje_raw))
             texto = (
                 "📝 *Resultado de consulta de firma (formato no esperado)*\n\n"
                 f"`{str(mensaje_raw)}`"
             )
             return texto
 
-        print(f"[DEBUG] formatear_respuesta_firma.info (tipo={type(info)}): {info}")
+        log.debug("formatear_respuesta_firma.info (tipo=%s): %s", type(info), info)
 
         # 2) Intentar formato "viejo": person/persona
         person = info.get("person") or info.get("persona") or {}
         if person:
-            nombre = " ".join(
-                [
-                    person.get("nombre1", ""),
-                    person.get("nombre2", ""),
-                    person.get("apellido1", ""),
-                    person.get("apellido2", ""),
-                ]
-            ).strip()
-            tipo_doc = person.get("idTipoDoc") or person.get("tipoDocumento") or ""
-            nro_doc = person.get("nroDocumento") or person.get("nroDoc") or ""
+            nombre = _nombre_completo(person)
+            tipo_doc = _primer_valor(person, _CLAVES_TIPO_DOC, "")
+            nro_doc = _primer_valor(person, _CLAVES_NRO_DOC, "")
             firma_b64 = person.get("firma") or info.get("firma")
         else:
             # 3) Formato "nuevo": campos en la raíz
@@ -1407,18 +2101,8 @@ def formatear_respuesta_firma(data: dict):
             apellidos = info.get("apellidos") or ""
             nombre = f"{nombres} {apellidos}".strip()
 
-            tipo_doc = (
-                info.get("tipoDocumento")
-                or info.get("idTipoDoc")
-                or info.get("tipoDoc")
-                or ""
-            )
-            nro_doc = (
-                info.get("numeroDocumento")
-                or info.get("nroDocumento")
-                or info.get("nroDoc")
-                or ""
-            )
+            tipo_doc = _primer_valor(info, _CLAVES_TIPO_DOC, "")
+            nro_doc = _primer_valor(info, _CLAVES_NRO_DOC, "")
             firma_b64 = info.get("firma")
 
         grupo = info.get("grupoSanguineo") or "-"
@@ -1432,15 +2116,15 @@ def formatear_respuesta_firma(data: dict):
 
         texto = (
             "📝 *Resultado de consulta de firma*\n\n"
-            f"*Nombre:* {nombre or '-'}\n"
-            f"*Documento:* {tipo_doc} {nro_doc}\n"
-            f"*Sexo:* {sexo}\n"
-            f"*Grupo sanguíneo:* {grupo}\n"
-            f"*Fecha de nacimiento:* {fecha_nac_fmt}\n"
-            f"*Lugar de nacimiento:* {lugar_nac}\n"
+            f"*Nombre:* {_md(nombre or '-')}\n"
+            f"*Documento:* {_md(tipo_doc)} {_md(nro_doc)}\n"
+            f"*Sexo:* {_md(sexo)}\n"
+            f"*Grupo sanguíneo:* {_md(grupo)}\n"
+            f"*Fecha de nacimiento:* {_md(fecha_nac_fmt)}\n"
+            f"*Lugar de nacimiento:* {_md(lugar_nac)}\n"
         )
 
-        print(f"[DEBUG] formatear_respuesta_firma.texto: {texto!r}")
+        log.debug("formatear_respuesta_firma.texto: %r", texto)
 
         # Si tenemos firma, la devolvemos también
         if firma_b64:
@@ -1448,38 +2132,65 @@ def formatear_respuesta_firma(data: dict):
 
         return texto
 
-    except Exception as e:
-        print(f"[ERROR] formateando firma: {e}")
+    except Exception:
+        log.exception("formateando firma")
         return textos.MENSAJE_ERROR_GENERICO
 
 
 def formatear_respuesta_persona(data: dict) -> str:
     try:
-        mensaje_str = data.get("Mensaje") or data.get("mensaje") or ""
-        info = json.loads(mensaje_str)
+        mensaje_str = _mensaje_de(data)
+        info = mensaje_str if isinstance(mensaje_str, dict) else _loads(mensaje_str)
 
         person = info.get("person") or info.get("persona") or info.get("personDTO") or {}
-        nombre = " ".join(
-            [
-                person.get("nombre1", ""),
-                person.get("nombre2", ""),
-                person.get("apellido1", ""),
-                person.get("apellido2", ""),
-            ]
-        ).strip()
-        tipo_doc = person.get("idTipoDoc") or person.get("tipoDocumento") or ""
-        nro_doc = person.get("nroDocumento") or person.get("nroDoc") or ""
+        nombre = _nombre_completo(person)
+        tipo_doc = _primer_valor(person, _CLAVES_TIPO_DOC, "")
+        nro_doc = _primer_valor(person, _CLAVES_NRO_DOC, "")
 
         return (
             "🧍 *Consulta de persona*\n\n"
-            f"*Nombre:* {nombre or '-'}\n"
-            f"*Documento:* {tipo_doc} {nro_doc}\n"
+            f"*Nombre:* {_md(nombre or '-')}\n"
+            f"*Documento:* {_md(tipo_doc)} {_md(nro_doc)}\n"
         )
-    except Exception as e:
-        print(f"[ERROR] formateando persona: {e}")
+    except Exception:
+        log.exception("formateando persona")
         return textos.MENSAJE_ERROR_GENERICO
 
 
+# Claves que indican que los datos del vehículo vienen en la raíz de Mensaje
+_CLAVES_RAIZ_VEHICULO = frozenset(
+    ("placaNumeroUnicoIdentificacion", "placa", "marcaVehiculo", "lineaVehiculo")
+)
+
+
+def _estructura_vehiculo(info: dict) -> Tuple[dict, dict]:
+    """
+    Devuelve (datos, adicional) según la estructura de Mensaje:
+    {"datos": ...}, {"vehiculo": {"datos": ...}}, {"vehiculo": {...}} o
+    campos del vehículo en la raíz.
+    """
+    datos = info.get("datos")
+    if isinstance(datos, dict):
+        log.debug("formatear_respuesta_vehiculo: usando info['datos']")
+        return datos, info.get("adicional") or {}
+
+    veh = info.get("vehiculo")
+    if isinstance(veh, dict):
+        datos = veh.get("datos")
+        if isinstance(datos, dict):
+            log.debug("formatear_respuesta_vehiculo: usando info['vehiculo']['datos']")
+            return datos, veh.get("adicional") or {}
+        log.debug("formatear_respuesta_vehiculo: usando info['vehiculo'] directo")
+        return veh, info.get("adicional") or {}
+
+    if not _CLAVES_RAIZ_VEHICULO.isdisjoint(info.keys()):
+        log.debug("formatear_respuesta_vehiculo: usando info directo (campos en raíz)")
+        return info, info.get("adicional") or {}
+
+    log.debug("formatear_respuesta_vehiculo: no se encontró 'datos' ni 'vehiculo' adecuados")
+    return {}, {}
+
+
 def formatear_respuesta_vehiculo(data: dict) -> str:
     """
     Formatea la respuesta de vehículo para mostrarla en Telegram.
@@ -1487,16 +2198,16 @@ def formatear_respuesta_vehiculo(data: dict) -> str:
     Cada campo va en su propia línea.
     """
     try:
-        mensaje_raw = data.get("Mensaje") or data.get("mensaje") or ""
-        print(f"[DEBUG] formatear_respuesta_vehiculo.mensaje_raw (tipo={type(mensaje_raw)}): {mensaje_raw}")
+        mensaje_raw = _mensaje_de(data)
+        log.debug("formatear_respuesta_vehiculo.mensaje_raw (tipo=%s): %s", type(mensaje_raw), mensaje_raw)
 
         # --- Parsear mensaje: puede ser string JSON o dict ---
         info = {}
         if isinstance(mensaje_raw, str):
             try:
-                info = json.loads(mensaje_raw)
+                info = _loads(mensaje_raw)
             except Exception as e:
-                print(f"[ERROR] formatear_respuesta_vehiculo: no se pudo json.loads(mensaje_raw): {e}")
+                log.error("formatear_respuesta_vehiculo: no se pudo decodificar mensaje_raw: %s", e)
                 return (
                     "🚗 *Respuesta de vehículo (sin formato JSON)*\n\n"
                     f"`{mensaje_raw}`"
@@ -1504,109 +2215,61 @@ def formatear_respuesta_vehiculo(data: dict) -> str:
         elif isinstance(mensaje_raw, dict):
             info = mensaje_raw
         else:
-            print(f"[DEBUG] formatear_respuesta_vehiculo: mensaje_raw tipo inesperado: {type(mensaje_raw)}")
+            log.debug("formatear_respuesta_vehiculo: mensaje_raw tipo inesperado: %s", type(mensaje_raw))
             return (
                 "🚗 *Respuesta de vehículo (formato no esperado)*\n\n"
                 f"`{str(mensaje_raw)}`"
             )
 
-        print(f"[DEBUG] formatear_respuesta_vehiculo.info (tipo={type(info)}): {info}")
+        log.debug("formatear_respuesta_vehiculo.info (tipo=%s): %s", type(info), info)
 
         # Detectar estructura de datos del vehículo
-        datos = {}
-        adicional = {}
-
-        if isinstance(info, dict) and "datos" in info and isinstance(info["datos"], dict):
-            datos = info["datos"]
-            adicional = info.get("adicional") or {}
-            print("[DEBUG] formatear_respuesta_vehiculo: usando info['datos']")
-        else:
-            veh = info.get("vehiculo")
-            if isinstance(veh, dict):
-                if "datos" in veh and isinstance(veh["datos"], dict):
-                    datos = veh["datos"]
-                    adicional = veh.get("adicional") or {}
-                    print("[DEBUG] formatear_respuesta_vehiculo: usando info['vehiculo']['datos']")
-                else:
-                    datos = veh
-                    adicional = info.get("adicional") or {}
-                    print("[DEBUG] formatear_respuesta_vehiculo: usando info['vehiculo'] directo")
-            else:
-                if any(
-                    k in info
-                    for k in (
-                        "placaNumeroUnicoIdentificacion",
-                        "placa",
-                        "marcaVehiculo",
-                        "lineaVehiculo",
-                    )
-                ):
-                    datos = info
-                    adicional = info.get("adicional") or {}
-                    print("[DEBUG] formatear_respuesta_vehiculo: usando info directo (campos en raíz)")
-                else:
-                    print("[DEBUG] formatear_respuesta_vehiculo: no se encontró 'datos' ni 'vehiculo' adecuados")
+        datos, adicional = _estructura_vehiculo(info)
 
         datos = datos or {}
-        print(f"[DEBUG] formatear_respuesta_vehiculo.datos: {datos}")
-        print(f"[DEBUG] formatear_respuesta_vehiculo.adicional: {adicional}")
-
-        # Campos del vehículo
-        placa = (
-            datos.get("placaNumeroUnicoIdentificacion")
-            or datos.get("placa")
-            or "-"
-        )
-        clase = datos.get("claseVehiculo") or "-"
-        marca = datos.get("marcaVehiculo") or "-"
-        linea = datos.get("lineaVehiculo") or "-"
-        modelo = datos.get("modelo") or "-"
-        color = datos.get("color") or "-"
-        carroceria = datos.get("carroceria") or "-"
-        cilindraje = datos.get("cilindraje") or "-"
-        servicio = datos.get("servicio") or "-"
-        estado_registro = datos.get("estadoRegistroVehiculo") or "-"
-        numero_motor = datos.get("numeroMotor") or "-"
-        numero_chasis = datos.get("numeroChasis") or "-"
-        vin = datos.get("vin") or "-"
+        log.debug("formatear_respuesta_vehiculo.datos: %s", datos)
+        log.debug("formatear_respuesta_vehiculo.adicional: %s", adicional)
+
+        # Campos del vehículo: una pasada sobre la especificación declarativa
+        campos = {
+            nombre: _md(_primer_valor(datos, claves)) for nombre, claves in _CAMPOS_VEHICULO
+        }
+        # La placa va dentro del título en negrita y de un `código`: sin escapar
+        campos["placa"] = _md_en_entidad(_primer_valor(datos, _CLAVES_PLACA))
+        # Estos dos conservan el valor tal cual (p. ej. False), solo faltante -> "-"
         inscrito_runt = datos.get("vehiculoInscritoRUNT", "-")
         gravamenes = datos.get("poseeGravamenes", "-")
 
-        tipo_combustible = (
-            datos.get("tipoCombustible")
-            or datos.get("combustible")
-            or datos.get("tipoCombustibleVehiculo")
-            or "-"
-        )
-
         # SOAT / RTM
         lista_polizas = adicional.get("listaPolizas") or []
-        soat_list = [
-            p for p in lista_polizas
-            if (p.get("tipoPoliza", "") or "").upper() == "SOAT"
-        ]
-
         lista_rtm = adicional.get("listaRtm") or []
 
-        def calcular_vigente(fecha_str, formato="%d/%m/%Y"):
+        hoy = date.today()
+
+        def vigente(fecha_str) -> bool:
             try:
-                fecha = datetime.strptime(fecha_str, formato).date()
-                hoy = datetime.now().date()
-                return "SI" if fecha >= hoy else "NO"
+                return _parse_fecha_dmy(fecha_str) >= hoy
             except Exception:
-                return "-"
+                return False
+
+        # Una pasada: la primera SOAT es la última póliza y se corta en la
+        # primera vigente
+        ultima_poliza = None
+        soat_vigente = "NO"
+        for p in lista_polizas:
+            if (p.get("tipoPoliza", "") or "").upper() != "SOAT":
+                continue
+            if ultima_poliza is None:
+                ultima_poliza = p
+            if vigente(p.get("fechaVencimiento", "")):
+                soat_vigente = "SI"
+                break
 
-        soat_vigente = "SI" if any(
-            calcular_vigente(p.get("fechaVencimiento", "")) == "SI"
-            for p in soat_list
-        ) else "NO"
         rtm_vigente = "SI" if any(
-            calcular_vigente(r.get("fechaVigencia", "")) == "SI"
-            for r in lista_rtm
+            vigente(r.get("fechaVigencia", "")) for r in lista_rtm
         ) else "NO"
 
-        # Última póliza y RTM (si existen)
-        ultima_poliza = soat_list[0] if soat_list else None
+        # Última RTM (si existe)
         ultima_rtm = lista_rtm[0] if lista_rtm else None
 
         # Propietario (persona natural / jurídica / fallback)
@@ -1619,28 +2282,13 @@ def formatear_respuesta_vehiculo(data: dict) -> str:
         datos_empresa = persona_info.get("datosEmpresa") or {}
 
         if person:
-            nombre_prop = " ".join(
-                [
-                    person.get("nombre1", ""),
-                    person.get("nombre2", ""),
-                    person.get("apellido1", ""),
-                    person.get("apellido2", ""),
-                ]
-            ).strip() or "-"
-            tipo_doc_prop = person.get("idTipoDoc") or person.get("tipoDocumento") or "-"
-            nro_doc_prop = person.get("nroDocumento") or person.get("numeroDocumento") or "-"
+            nombre_prop = _nombre_completo(person) or "-"
+            tipo_doc_prop = _primer_valor(person, _CLAVES_TIPO_DOC, "-")
+            nro_doc_prop = _primer_valor(person, _CLAVES_NRO_DOC, "-")
         elif datos_empresa:
             nombre_prop = datos_empresa.get("razonSocial") or "-"
-            tipo_doc_prop = (
-                datos_empresa.get("tipoDocumentoEmpresa")
-                or datos_empresa.get("tipoDocumentoId")
-                or "NIT"
-            )
-            nro_doc_prop = (
-                datos_empresa.get("numeroDocumentoEmpresa")
-                or datos_empresa.get("nroDocumento")
-                or "-"
-            )
+            tipo_doc_prop = _primer_valor(datos_empresa, _CLAVES_TIPO_DOC_EMPRESA, "NIT")
+            nro_doc_prop = _primer_valor(datos_empresa, _CLAVES_NRO_DOC_EMPRESA, "-")
         else:
             # Fallback desde listaComparendos (si viene allí)
             lista_comparendos_local = adicional.get("listaComparendos") or []
@@ -1654,140 +2302,131 @@ def formatear_respuesta_vehiculo(data: dict) -> str:
         lista_accidentes = adicional.get("listaAccidentes") or []
         accidentes_count = len(lista_accidentes)
 
-        licencias_list = []
         lista_comparendos = adicional.get("listaComparendos") or []
-        if lista_comparendos:
-            comp = lista_comparendos[0]
-            for lic in comp.get("listaLicencias") or []:
-                licencias_list.append(
-                    {
-                        "numero": lic.get("numeroLicencia", "") or "",
-                        "categoria": lic.get("categoria", "") or "",
-                        "estado": lic.get("estado", "") or "",
-                    }
-                )
+        lista_licencias = (lista_comparendos[0].get("listaLicencias") or []) if lista_comparendos else []
 
         # Blindaje
         info_veh_dto = adicional.get("informacionVehiculoDTO", {}) or {}
         blindado = info_veh_dto.get("blindado", "-")
 
-        # --- Construir mensaje, 1 campo por línea ---
-        partes = []
-
-        partes.append(f"🚗 *Informe vehicular – {placa}*")
-        partes.append("")
-
-        # 1. Datos principales
-        partes.append("*1. Datos principales del vehículo*")
-        partes.append(f"• Placa: `{placa}`")
-        partes.append(f"• Clase: {clase}")
-        partes.append(f"• Servicio: {servicio}")
-        partes.append(f"• Estado del registro: {estado_registro}")
-        partes.append("")
-
-        # 2. Características del vehículo (una sola etiqueta por línea)
-        partes.append("*2. Características del vehículo*")
-        partes.append(f"• Marca: {marca}")
-        partes.append(f"• Línea: {linea}")
-        partes.append(f"• Modelo: {modelo}")
-        partes.append(f"• Color: {color}")
-        partes.append(f"• Carrocería: {carroceria}")
-        partes.append(f"• Cilindraje: {cilindraje}")
-        partes.append(f"• Tipo de combustible: {tipo_combustible}")
-        partes.append(f"• Nro. Motor: {numero_motor}")
-        partes.append(f"• Nro. Chasis: {numero_chasis}")
-        partes.append(f"• Nro. VIN: {vin}")
-        partes.append("")
-
-        # 3. Documentos y seguridad
-        partes.append("*3. Estado de documentos y seguridad*")
-        partes.append(f"• Inscrito en RUNT: {inscrito_runt}")
-        partes.append(f"• Posee gravámenes: {gravamenes}")
-        partes.append(f"• SOAT vigente: {soat_vigente}")
-        if ultima_poliza:
-            partes.append("• Detalle de la última póliza SOAT:")
-            partes.append(f"  ─ Número de póliza: {ultima_poliza.get('numeroPoliza','-')}")
-            partes.append(f"  ─ Entidad aseguradora: {ultima_poliza.get('aseguradora','-')}")
-            partes.append(f"  ─ Fecha inicio vigencia: {ultima_poliza.get('fechaInicio','-')}")
-            partes.append(f"  ─ Fecha fin vigencia: {ultima_poliza.get('fechaVencimiento','-')}")
-        partes.append(f"• RTM vigente: {rtm_vigente}")
-        if ultima_rtm:
-            partes.append("• Detalle de la última revisión técnico-mecánica:")
-            partes.append(f"  ─ Tipo de revisión: {ultima_rtm.get('tipoRevision','-')}")
-            partes.append(f"  ─ CDA: {ultima_rtm.get('nombreCda','-')}")
-            partes.append(f"  ─ Fecha expedición: {ultima_rtm.get('fechaExpedicion','-')}")
-            partes.append(f"  ─ Fecha vigencia: {ultima_rtm.get('fechaVigencia','-')}")
-        partes.append("")
-
-        # 4. Propietario (si hay información)
-        if nombre_prop != "-" or nro_doc_prop != "-":
-            partes.append("*4. Propietario*")
-            partes.append(f"• Nombre / Razón social: {nombre_prop}")
-            partes.append(f"• Tipo de documento: {tipo_doc_prop}")
-            partes.append(f"• Número de documento: {nro_doc_prop}")
-            partes.append("")
-
-        # 5. Información adicional
-        partes.append("*5. Información adicional*")
-        partes.append(f"• Blindado: {blindado}")
-        partes.append(f"• Accidentes reportados: {accidentes_count}")
-        if licencias_list:
-            partes.append("• Licencia(s) de conducción asociada(s):")
-            for idx, lic in enumerate(licencias_list, start=1):
-                partes.append(f"  ─ Licencia #{idx}:")
-                partes.append(f"    • Número de licencia: {lic['numero']}")
-                partes.append(f"    • Categoría: {lic['categoria']}")
-                partes.append(f"    • Estado: {lic['estado']}")
-
-        return "\n".join(partes)
-
-    except Exception as e:
-        print(f"[ERROR] formateando vehículo: {e}")
+        # --- Construir mensaje, 1 campo por línea (plantilla única) ---
+        detalle_soat = _PLANTILLA_VEHICULO_SOAT.format(
+            numero=_md(ultima_poliza.get("numeroPoliza", "-")),
+            aseguradora=_md(ultima_poliza.get("aseguradora", "-")),
+            inicio=_md(ultima_poliza.get("fechaInicio", "-")),
+            fin=_md(ultima_poliza.get("fechaVencimiento", "-")),
+        ) if ultima_poliza else ""
+        detalle_rtm = _PLANTILLA_VEHICULO_RTM.format(
+            tipo=_md(ultima_rtm.get("tipoRevision", "-")),
+            cda=_md(ultima_rtm.get("nombreCda", "-")),
+            expedicion=_md(ultima_rtm.get("fechaExpedicion", "-")),
+            vigencia=_md(ultima_rtm.get("fechaVigencia", "-")),
+        ) if ultima_rtm else ""
+        propietario = _PLANTILLA_VEHICULO_PROPIETARIO.format(
+            nombre=_md(nombre_prop), tipo_doc=_md(tipo_doc_prop), nro_doc=_md(nro_doc_prop),
+        ) if (nombre_prop != "-" or nro_doc_prop != "-") else ""
+        licencias = ""
+        if lista_licencias:
+            # Cada licencia se formatea directo a la plantilla, sin dicts intermedios
+            licencias = "\n• Licencia(s) de conducción asociada(s):" + "".join(
+                _PLANTILLA_VEHICULO_LICENCIA.format(
+                    idx=idx,
+                    numero=_md(lic.get("numeroLicencia", "") or ""),
+                    categoria=_md(lic.get("categoria", "") or ""),
+                    estado=_md(lic.get("estado", "") or ""),
+                )
+                for idx, lic in enumerate(lista_licencias, start=1)
+            )
+
+        return _PLANTILLA_VEHICULO.format(
+            **campos,
+            inscrito_runt=_md(inscrito_runt),
+            gravamenes=_md(gravamenes),
+            soat_vigente=soat_vigente,
+            detalle_soat=detalle_soat,
+            rtm_vigente=rtm_vigente,
+            detalle_rtm=detalle_rtm,
+            propietario=propietario,
+            blindado=_md(blindado),
+            accidentes_count=accidentes_count,
+            licencias=licencias,
+        )
+
+    except Exception:
+        log.exception("formateando vehículo")
         return textos.MENSAJE_ERROR_GENERICO
 
 
 def formatear_respuesta_propietario(data: dict) -> str:
     try:
-        mensaje_str = data.get("Mensaje") or data.get("mensaje") or ""
-        info = json.loads(mensaje_str)
+        mensaje_str = _mensaje_de(data)
+        info = mensaje_str if isinstance(mensaje_str, dict) else _loads(mensaje_str)
 
         persona = info.get("persona") or {}
         datos_empresa = persona.get("datosEmpresa") or info.get("datosEmpresa") or {}
 
         person = persona.get("person") or {}
-        nombre_persona = " ".join(
-            [
-                person.get("nombre1", ""),
-                person.get("nombre2", ""),
-                person.get("apellido1", ""),
-                person.get("apellido2", ""),
-            ]
-        ).strip()
-        tipo_doc = person.get("idTipoDoc") or person.get("tipoDocumento") or ""
-        nro_doc = person.get("nroDocumento") or person.get("nroDoc") or ""
+        nombre_persona = _nombre_completo(person)
+        tipo_doc = _primer_valor(person, _CLAVES_TIPO_DOC, "")
+        nro_doc = _primer_valor(person, _CLAVES_NRO_DOC, "")
 
         if not nombre_persona and datos_empresa:
             nombre_persona = datos_empresa.get("razonSocial", "")
-            tipo_doc = datos_empresa.get("tipoDocumentoEmpresa") or "NIT"
-            nro_doc = datos_empresa.get("numeroDocumentoEmpresa") or ""
+            tipo_doc = _primer_valor(datos_empresa, _CLAVES_TIPO_DOC_EMPRESA, "NIT")
+            nro_doc = _primer_valor(datos_empresa, _CLAVES_NRO_DOC_EMPRESA, "")
 
         if not nombre_persona:
             nombre_persona = "-"
 
         return (
             "👤 *Propietario del vehículo*\n\n"
-            f"*Nombre / Razón social:* {nombre_persona}\n"
-            f"*Documento:* {tipo_doc} {nro_doc}\n"
+            f"*Nombre / Razón social:* {_md(nombre_persona)}\n"
+            f"*Documento:* {_md(tipo_doc)} {_md(nro_doc)}\n"
         )
-    except Exception as e:
-        print(f"[ERROR] formateando propietario: {e}")
+    except Exception:
+        log.exception("formateando propietario")
         return textos.MENSAJE_ERROR_GENERICO
 
 # =====================================================================
 # 11. LÓGICA DE NEGOCIO: INICIAR CONSULTAS
 # =====================================================================
 
-def _verificar_creditos_o_mensaje(chat_id: int, usuario: Usuario, config: ConsultaConfig) -> bool:
+# Tabla de traducción que elimina espacios en blanco de una placa en una pasada
+_PLACA_TT = str.maketrans("", "", " \t\r\n")
+
+
+def _limpiar_placa(placa: str) -> str:
+    """Quita espacios en blanco y pasa la placa a mayúsculas ("pdk 400" -> "PDK400")."""
+    return placa.translate(_PLACA_TT).upper()
+
+
+# Formatos de placa colombiana: ABC123 (carro), ABC12D / ABC12 (moto),
+# R12345 / S12345 (remolque) y CD1234 (diplomática y similares)
+_PLACA_RE = re.compile(r"[A-Z]{3}\d{2,3}[A-Z]?|[A-Z]{1,2}\d{4,5}")
+# Número de documento: solo letras y dígitos (cédulas, NIT sin DV, pasaportes)
+_NUM_DOC_RE = re.compile(r"[0-9A-Za-z]{3,20}")
+
+
+def _placa_valida_o_mensaje(chat_id: int, placa_limpia: str) -> bool:
+    """
+    Descarta antes de llamar a la API las placas con formato imposible
+    (ahorra la petición, el polling y la consulta de créditos).
+    """
+    if _PLACA_RE.fullmatch(placa_limpia):
+        return True
+    enviar_mensaje(chat_id, "⚠️ Placa inválida. Escríbela sin guiones, por ejemplo: `ABC123`.")
+    return False
+
+
+def _num_doc_valido_o_mensaje(chat_id: int, num_doc: str) -> bool:
+    """Igual que _placa_valida_o_mensaje para el número de documento."""
+    if _NUM_DOC_RE.fullmatch(num_doc):
+        return True
+    enviar_mensaje(chat_id, "⚠️ Número de documento inválido. Escríbelo sin puntos ni guiones.")
+    return False
+
+
+def _verificar_creditos_o_mensaje(chat_id: int, usuario: UsuarioSnapshot, config: Optional[SimpleNamespace]) -> bool:
     """
     Devuelve True si el usuario tiene créditos y la consulta está ACTIVA.
     En caso contrario envía el mensaje correspondiente y devuelve False.
@@ -1798,8 +2437,7 @@ def _verificar_creditos_o_mensaje(chat_id: int, usuario: Usuario, config: Consul
 
     db = get_db()
     try:
-        usuario_db = db.query(Usuario).filter_by(id=usuario.id).one()
-        disponibles = usuario_creditos_disponibles(usuario_db)
+        disponibles = usuario_creditos_disponibles(leer_creditos(db, usuario.id))
         if disponibles < config.valor_consulta:
             enviar_mensaje(chat_id, textos.MENSAJE_SIN_CREDITOS)
             return False
@@ -1809,11 +2447,14 @@ def _verificar_creditos_o_mensaje(chat_id: int, usuario: Usuario, config: Consul
     return True
 
 
-def iniciar_consulta_firma(usuario: Usuario, chat_id: int, tipo_doc: str, num_doc: str):
+def iniciar_consulta_firma(usuario: UsuarioSnapshot, chat_id: int, tipo_doc: str, num_doc: str):
     """
     Para tipo 8, la API espera:
       "mensaje": "CC,15645123"
     """
+    if not _num_doc_valido_o_mensaje(chat_id, num_doc):
+        return
+
     config = get_consulta_config(TIPO_CONSULTA_FIRMA)
     if not _verificar_creditos_o_mensaje(chat_id, usuario, config):
         return
@@ -1823,8 +2464,8 @@ def iniciar_consulta_firma(usuario: Usuario, chat_id: int, tipo_doc: str, num_do
 
     try:
         id_peticion = llamar_iniciar_consulta(TIPO_CONSULTA_FIRMA, mensaje_payload)
-    except Exception as e:
-        print(f"[ERROR] iniciar_consulta_firma -> IniciarConsulta: {e}")
+    except Exception:
+        log.exception("iniciar_consulta_firma -> IniciarConsulta")
         enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
         return
 
@@ -1850,12 +2491,15 @@ def iniciar_consulta_firma(usuario: Usuario, chat_id: int, tipo_doc: str, num_do
     )
 
 
-def iniciar_consulta_persona(usuario: Usuario, chat_id: int, tipo_doc: str, num_doc: str):
+def iniciar_consulta_persona(usuario: UsuarioSnapshot, chat_id: int, tipo_doc: str, num_doc: str):
     """
     Para tipo 5, la API también espera:
       "mensaje": "CC,15645123"
     (NO JSON).
     """
+    if not _num_doc_valido_o_mensaje(chat_id, num_doc):
+        return
+
     config = get_consulta_config(TIPO_CONSULTA_PERSONA)
     if not _verificar_creditos_o_mensaje(chat_id, usuario, config):
         return
@@ -1868,8 +2512,8 @@ def iniciar_consulta_persona(usuario: Usuario, chat_id: int, tipo_doc: str, num_
 
     try:
         id_peticion = llamar_iniciar_consulta(TIPO_CONSULTA_PERSONA, mensaje_param_api)
-    except Exception as e:
-        print(f"[ERROR] iniciar_consulta_persona -> IniciarConsulta: {e}")
+    except Exception:
+        log.exception("iniciar_consulta_persona -> IniciarConsulta")
         enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
         return
 
@@ -1892,24 +2536,27 @@ def iniciar_consulta_persona(usuario: Usuario, chat_id: int, tipo_doc: str, num_
     )
 
 
-def iniciar_consulta_vehiculo(usuario: Usuario, chat_id: int, placa: str):
+def iniciar_consulta_vehiculo(usuario: UsuarioSnapshot, chat_id: int, placa: str):
     """
     Consulta de vehículo por placa (tipo 3).
     En IniciarConsulta la API espera:
       "mensaje": "PDK400"
     (solo la placa, no JSON).
     """
+    placa_limpia = _limpiar_placa(placa)
+    if not _placa_valida_o_mensaje(chat_id, placa_limpia):
+        return
+
     config = get_consulta_config(TIPO_CONSULTA_VEHICULO_SOLO)
     if not _verificar_creditos_o_mensaje(chat_id, usuario, config):
         return
 
-    placa_limpia = placa.replace(" ", "").upper()
     mensaje_payload = placa_limpia
 
     try:
         id_peticion = llamar_iniciar_consulta(TIPO_CONSULTA_VEHICULO_SOLO, mensaje_payload)
-    except Exception as e:
-        print(f"[ERROR] iniciar_consulta_vehiculo -> IniciarConsulta: {e}")
+    except Exception:
+        log.exception("iniciar_consulta_vehiculo -> IniciarConsulta")
         enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
         return
 
@@ -1932,22 +2579,25 @@ def iniciar_consulta_vehiculo(usuario: Usuario, chat_id: int, placa: str):
     )
 
 
-def iniciar_consulta_propietario(usuario: Usuario, chat_id: int, placa: str):
+def iniciar_consulta_propietario(usuario: UsuarioSnapshot, chat_id: int, placa: str):
     """
     Consulta de propietario por placa (tipo 4).
     La API espera también solo la placa como string.
     """
+    placa_limpia = _limpiar_placa(placa)
+    if not _placa_valida_o_mensaje(chat_id, placa_limpia):
+        return
+
     config = get_consulta_config(TIPO_CONSULTA_PROPIETARIO_POR_PLACA)
     if not _verificar_creditos_o_mensaje(chat_id, usuario, config):
         return
 
-    placa_limpia = placa.replace(" ", "").upper()
     mensaje_payload = placa_limpia
 
     try:
         id_peticion = llamar_iniciar_consulta(TIPO_CONSULTA_PROPIETARIO_POR_PLACA, mensaje_payload)
-    except Exception as e:
-        print(f"[ERROR] iniciar_consulta_propietario -> IniciarConsulta: {e}")
+    except Exception:
+        log.exception("iniciar_consulta_propietario -> IniciarConsulta")
         enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
         return
 
@@ -1970,12 +2620,106 @@ def iniciar_consulta_propietario(usuario: Usuario, chat_id: int, placa: str):
     )
 
 # =====================================================================
-# 12. EJECUCIÓN EN HILO Y ENVÍO DE PDF
+# 12. POLLING DE RESULTADOS Y ENVÍO DE PDF
 # =====================================================================
 
+# Un único bucle asyncio (en su propio hilo) espera los resultados de todas
+# las consultas en curso: entre sondeos no se ocupa ningún hilo. Con httpx
+# cada GET a /resultados también es asíncrono (un pool de conexiones
+# compartido); sin httpx se ejecuta con requests en el executor del bucle.
+_POLL_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_POLL_LOOP.run_forever, name="poll-resultados", daemon=True).start()
+
+_RESULTADOS_CLIENT = httpx.AsyncClient(timeout=30) if httpx is not None else None
+
+# El cierre de cada consulta (BD, formateo, PDF, envíos) es bloqueante y
+# corre en este pool acotado en lugar de un hilo nuevo por consulta.
+_CONSULTA_POOL = ThreadPoolExecutor(max_workers=CONSULTA_WORKERS, thread_name_prefix="consulta")
+
+
+async def _poll_resultados(id_peticion: str, descripcion: str) -> Optional[dict]:
+    """
+    Consulta /resultados mientras la petición siga en proceso (Tipo 2),
+    hasta RESULTADOS_TIMEOUT, con backoff exponencial y jitter entre
+    intentos para no sincronizar a todas las consultas en curso.
+    Devuelve la última respuesta recibida, tal como llegó (o None si no
+    hubo ninguna).
+    """
+    loop = asyncio.get_running_loop()
+    # Referencias locales: el bucle puede iterar muchas veces por consulta
+    ahora = loop.time
+    ejecutar = loop.run_in_executor
+    asincrono = _RESULTADOS_CLIENT is not None
+    uniform = random.uniform
+    jitter_min = 1 - RESULTADOS_BACKOFF_JITTER
+    jitter_max = 1 + RESULTADOS_BACKOFF_JITTER
+
+    deadline = ahora() + RESULTADOS_TIMEOUT
+    ultimo_data = None
+    delay = RESULTADOS_BACKOFF_BASE
+
+    while ahora() < deadline:
+        if asincrono:
+            data = await llamar_resultados_async(id_peticion)
+        else:
+            data = await ejecutar(None, llamar_resultados, id_peticion)
+        ultimo_data = data
+
+        normalizado = _normalizar_resultados(data)
+        tipo = normalizado.get("tipo")
+        mensaje = normalizado.get("mensaje")
+
+        log.debug("Resultado parcial (%s) -> Tipo=%s, Mensaje=%s", descripcion, tipo, mensaje)
+
+        # Tipo 2 -> procesando
+        if tipo == 2:
+            espera = delay * uniform(jitter_min, jitter_max)
+            delay = min(delay * RESULTADOS_BACKOFF_FACTOR, RESULTADOS_BACKOFF_CAP)
+            await asyncio.sleep(min(espera, max(deadline - ahora(), 0)))
+            continue
+
+        # Tipo 0 / 1 -> respuesta final
+        break
+
+    return ultimo_data
+
+
+def submit_poll(id_peticion: str, callback, descripcion: str = "") -> None:
+    """
+    Programa el polling de id_peticion en _POLL_LOOP. Al terminar se llama
+    callback(future) desde el hilo del bucle; future.result() devuelve la
+    última respuesta o relanza el error del polling.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        _poll_resultados(id_peticion, descripcion),
+        _POLL_LOOP,
+    )
+    future.add_done_callback(callback)
+
+
+def _con_mensaje_decodificado(data: dict) -> dict:
+    """
+    Copia superficial de la respuesta de /resultados con 'mensaje' ya
+    decodificado a dict. Si no es JSON de objeto se deja como venía
+    (los consumidores ya manejan el caso de texto crudo).
+    """
+    mensaje_raw = data.get("mensaje")
+    if not isinstance(mensaje_raw, str) or not mensaje_raw:
+        return data
+    try:
+        info = _loads(mensaje_raw)
+    except ValueError:
+        return data
+    # Un objeto vacío se deja como string: {} es falsy y cambiaría las
+    # comprobaciones de "Mensaje vacío" de los consumidores
+    if not isinstance(info, dict) or not info:
+        return data
+    return {**data, "mensaje": info}
+
+
 def ejecutar_consulta_en_hilo(
     chat_id: int,
-    usuario: Usuario,
+    usuario: UsuarioSnapshot,
     mensaje_id: int,
     tipo_consulta: int,
     mensaje_parametro_str: str,
@@ -1983,39 +2727,15 @@ def ejecutar_consulta_en_hilo(
     formateador_respuesta,
 ):
     """
-    Hilo que hace polling a /resultados y decide si se cobra o no.
+    Programa el polling a /resultados en _POLL_LOOP y, con la respuesta
+    final, decide en un hilo si se cobra o no.
     Ahora también permite que, en caso de consulta de vehículo,
     se genere y envíe un PDF con el informe vehicular.
     """
 
-    def _run():
+    def _run(future):
         try:
-            deadline = time.time() + RESULTADOS_TIMEOUT
-            ultimo_data = None
-
-            while time.time() < deadline:
-                data = llamar_resultados(id_peticion)
-                ultimo_data = data
-
-                tipo = data.get("Tipo")
-                if tipo is None:
-                    tipo = data.get("tipo")
-
-                mensaje = data.get("Mensaje") or data.get("mensaje")
-
-                print(
-                    f"[DEBUG] Resultado parcial "
-                    f"(tipo={tipo_consulta}, mensaje='{mensaje_parametro_str}') -> "
-                    f"Tipo={tipo}, Mensaje={mensaje}"
-                )
-
-                # Tipo 2 -> procesando
-                if tipo == 2:
-                    time.sleep(RESULTADOS_INTERVALO)
-                    continue
-
-                # Tipo 0 / 1 -> respuesta final
-                break
+            ultimo_data = future.result()
 
             if not ultimo_data:
                 marcar_mensaje_error_o_sin_datos(
@@ -2026,13 +2746,18 @@ def ejecutar_consulta_en_hilo(
                 enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
                 return
 
-            if es_respuesta_exitosa_hercules(ultimo_data):
+            # Mensaje llega como string JSON: se decodifica una sola vez y la
+            # validación y el formateador reciben la vista normalizada y ya
+            # decodificada. ultimo_data se guarda tal cual en respuesta_bruta.
+            datos_decod = _con_mensaje_decodificado(_normalizar_resultados(ultimo_data))
+
+            if es_respuesta_exitosa_hercules(datos_decod):
                 marcar_mensaje_exito_y_cobrar(mensaje_id, ultimo_data)
 
                 # formateador puede devolver:
                 #  - solo texto (str)
                 #  - (texto, firma_b64) en el caso de firma
-                resultado_formateo = formateador_respuesta(ultimo_data)
+                resultado_formateo = formateador_respuesta(datos_decod)
 
                 texto_respuesta = textos.MENSAJE_ERROR_GENERICO
                 firma_b64 = None
@@ -2054,31 +2779,21 @@ def ejecutar_consulta_en_hilo(
                 # === Si es consulta de vehículo, generamos y enviamos PDF ===
                 if tipo_consulta == TIPO_CONSULTA_VEHICULO_SOLO:
                     try:
-                        # Intentamos extraer la placa para usarla en el nombre del archivo
-                        placa_para_nombre = "VEHICULO"
-                        try:
-                            mensaje_str_local = ultimo_data.get("Mensaje") or ultimo_data.get("mensaje") or ""
-                            info_local = {}
-                            if isinstance(mensaje_str_local, str):
-                                info_local = json.loads(mensaje_str_local)
-                            elif isinstance(mensaje_str_local, dict):
-                                info_local = mensaje_str_local
-
-                            # Soportar estructuras con 'vehiculo' o con 'datos' en la raíz
-                            veh_local = info_local.get("vehiculo") or {}
-                            if not veh_local and "datos" in info_local:
-                                datos_local = info_local.get("datos") or {}
-                            else:
-                                datos_local = (veh_local.get("datos") or veh_local) if veh_local else {}
-                            placa_para_nombre = datos_local.get("placaNumeroUnicoIdentificacion", "VEHICULO")
-                        except Exception as e:
-                            print(f"[WARN] No se pudo extraer placa para nombre de PDF: {e}")
-
-                        pdf_bytes = generar_informe_vehicular_B7_v2(ultimo_data)
-                        nombre_pdf = f"Informe_vehicular_{placa_para_nombre}.pdf"
-                        enviar_documento_pdf(chat_id, nombre_pdf, pdf_bytes)
-                    except Exception as e:
-                        print(f"[ERROR] generando/enviando PDF vehicular: {e}")
+                        # Reutiliza el Mensaje ya decodificado: ni el nombre del archivo
+                        # ni el informe vuelven a parsear el JSON
+                        informe = extraer_modelo_informe(datos_decod)
+                        placa_para_nombre = informe.datos_vehiculo.get(
+                            "placaNumeroUnicoIdentificacion", "VEHICULO"
+                        )
+
+                        # Se envía el mismo buffer donde se escribió, sin copiarlo a bytes
+                        with io.BytesIO() as pdf_buf:
+                            generar_informe_vehicular_B7_v2(datos_decod, out=pdf_buf, informe=informe)
+                            pdf_buf.seek(0)
+                            nombre_pdf = f"Informe_vehicular_{placa_para_nombre}.pdf"
+                            enviar_documento_pdf(chat_id, nombre_pdf, pdf_buf)
+                    except Exception:
+                        log.exception("generando/enviando PDF vehicular")
 
             else:
                 marcar_mensaje_error_o_sin_datos(
@@ -2090,7 +2805,7 @@ def ejecutar_consulta_en_hilo(
                 enviar_mensaje(chat_id, textos.MENSAJE_SIN_DATOS)
 
         except Exception as e:
-            print(f"[ERROR] ejecutando consulta en hilo: {e}")
+            log.exception("ejecutando consulta en hilo")
             marcar_mensaje_error_o_sin_datos(
                 mensaje_id,
                 estado="error",
@@ -2098,7 +2813,13 @@ def ejecutar_consulta_en_hilo(
             )
             enviar_mensaje(chat_id, textos.MENSAJE_ERROR_GENERICO)
 
-    threading.Thread(target=_run, daemon=True).start()
+    submit_poll(
+        id_peticion,
+        # El callback corre en el hilo del bucle: el procesamiento final
+        # se delega a _CONSULTA_POOL para no bloquearlo.
+        lambda future: _CONSULTA_POOL.submit(_run, future),
+        descripcion=f"tipo={tipo_consulta}, mensaje='{mensaje_parametro_str}'",
+    )
 
 # =====================================================================
 # 13. FLASK + WEBHOOK TELEGRAM
@@ -2106,23 +2827,100 @@ def ejecutar_consulta_en_hilo(
 
 app = Flask(__name__)
 
+# Pool acotado que atiende los updates; el webhook solo encola y responde
+EXECUTOR = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="update")
+
+# Respuestas del webhook: el cuerpo {"ok": true} es constante y se arma una vez
+JSON_HEADERS = {"Content-Type": "application/json"}
+OK_RESPONSE = (b'{"ok":true}', 200, JSON_HEADERS)
+
+# Textos cuya única acción es responder un mensaje: se atienden en el
+# propio request y la respuesta viaja en el cuerpo del webhook.
+RESPUESTAS_INMEDIATAS = frozenset(
+    {
+        "/start",
+        "📝 Consulta de firma",
+        "🧍 Consulta de persona",
+        "🚗 Consulta de vehículo",
+        "👤 Propietario por placa",
+        "⬅ Volver al menú",
+    }
+)
+
 
 @app.route(f"/webhook/{WEBHOOK_SECRET_PATH}", methods=["POST"])
 def telegram_webhook():
-    update = request.get_json(force=True, silent=True) or {}
-    print(f"[DEBUG] Update recibido: {json.dumps(update, ensure_ascii=False)}")
+    """
+    Responde 200 de inmediato para que Telegram no reintente el update.
+
+    /start y los botones del menú se resuelven aquí mismo devolviendo el
+    sendMessage en el cuerpo de la respuesta; el resto se delega a EXECUTOR.
+    """
+    if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+        WEBHOOK_SECRET_TOKEN.encode(),
+    ):
+        return "", 401
+
+    try:
+        update = _loads(request.get_data(cache=False))
+    except ValueError:
+        update = None
+    if not isinstance(update, dict):
+        update = {}
+    log.debug("Update recibido: %s", update)
+
+    message = update.get("message") or update.get("edited_message") or {}
+    text = (message.get("text") or "").strip()
+
+    if (_comando(text) if text.startswith("/") else text) in RESPUESTAS_INMEDIATAS:
+        try:
+            respuesta = _handle_update(update)
+        except Exception:
+            log.exception("procesando update")
+            respuesta = None
+        if not respuesta:
+            return OK_RESPONSE
+        return _dumps(respuesta), 200, JSON_HEADERS
+
+    EXECUTOR.submit(_handle_update_seguro, update)
+    return OK_RESPONSE
+
+
+def _handle_update_seguro(update: dict) -> None:
+    try:
+        respuesta = _handle_update(update)
+        if respuesta:
+            # Respuesta pensada para el cuerpo del webhook: aquí ya no hay
+            # request abierto, así que se envía por la API.
+            enviar_mensaje(
+                respuesta["chat_id"],
+                respuesta["text"],
+                reply_markup=respuesta.get("reply_markup"),
+            )
+    except Exception:
+        log.exception("procesando update")
 
+
+def _handle_update(update: dict) -> Optional[dict]:
+    """
+    Lógica completa de un update: usuario, comandos, menú y estados.
+    Se ejecuta fuera del contexto de Flask.
+
+    Devuelve un payload sendMessage cuando la única acción es responder
+    un texto (ver enviar_mensaje(as_response=True)); si no, None.
+    """
     try:
         usuario = get_or_create_usuario_from_update(update)
-    except Exception as e:
-        print(f"[ERROR] obteniendo/creando usuario: {e}")
-        return jsonify({"ok": True}), 200
+    except Exception:
+        log.exception("obteniendo/creando usuario")
+        return
 
     message = update.get("message") or update.get("edited_message") or {}
     chat = message.get("chat", {})
     chat_id = chat.get("id")
     if not chat_id:
-        return jsonify({"ok": True}), 200
+        return
 
     text = (message.get("text") or "").strip()
 
@@ -2131,153 +2929,195 @@ def telegram_webhook():
     estado = estado_info.get("estado")
     datos_estado = estado_info.get("datos", {})
 
-    # ----------------- COMANDOS -------------------
-    if text.startswith("/start"):
-        enviar_mensaje(chat_id, textos.MENSAJE_BIENVENIDA, reply_markup=teclado_menu_principal())
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
+    # Comandos (/start, /saldo) y botones del menú: una sola búsqueda
+    if text.startswith("/"):
+        handler = COMMAND_HANDLERS.get(_comando(text))
+    else:
+        handler = EXACT_HANDLERS.get(text)
+    if handler is None:
+        handler = ESTADO_HANDLERS.get(estado)
+    if handler is not None:
+        return handler(usuario, chat_id, text, estado, datos_estado)
 
-    if text.startswith("/saldo"):
-        db = get_db()
-        try:
-            usuario_db = db.query(Usuario).filter_by(id=usuario.id).one()
-            total = usuario_db.creditos_total
-            usados = usuario_db.creditos_usados
-            disponibles = usuario_creditos_disponibles(usuario_db)
-        finally:
-            db.close()
-
-        msg = textos.MENSAJE_SALDO.format(
-            total=total,
-            usados=usados,
-            disponibles=disponibles,
-        )
-        enviar_mensaje(chat_id, msg, reply_markup=teclado_menu_principal())
-        return jsonify({"ok": True}), 200
-
-    # ----------------- MENÚ PRINCIPAL -------------------
-    if text == "📝 Consulta de firma":
-        enviar_mensaje(
-            chat_id,
-            "✍️ Has elegido *Consulta de firma*.\n\n"
-            "Primero selecciona el *tipo de documento*: 👇",
-            reply_markup=teclado_tipos_documento(),
-        )
-        set_user_state(chat_id, "firma_esperando_tipo_doc")
-        return jsonify({"ok": True}), 200
-
-    if text == "🧍 Consulta de persona":
-        enviar_mensaje(
-            chat_id,
-            "🧍 Has elegido *Consulta de persona*.\n\n"
-            "Primero selecciona el *tipo de documento*: 👇",
-            reply_markup=teclado_tipos_documento(),
-        )
-        set_user_state(chat_id, "persona_esperando_tipo_doc")
-        return jsonify({"ok": True}), 200
-
-    if text == "🚗 Consulta de vehículo":
-        enviar_mensaje(
-            chat_id,
-            "🚗 Has elegido *Consulta de vehículo por placa*.\n\n"
-            "👉 Escribe ahora la placa del vehículo (ejemplo: `ABC123`).",
-            reply_markup=teclado_menu_principal(),
-        )
-        set_user_state(chat_id, "esperando_placa_vehiculo")
-        return jsonify({"ok": True}), 200
-
-    if text == "👤 Propietario por placa":
-        enviar_mensaje(
-            chat_id,
-            "👤 Has elegido *Propietario por placa*.\n\n"
-            "👉 Escribe ahora la placa del vehículo.",
-            reply_markup=teclado_menu_principal(),
-        )
-        set_user_state(chat_id, "esperando_placa_propietario")
-        return jsonify({"ok": True}), 200
-
-    if text == "⬅ Volver al menú":
-        enviar_mensaje(
-            chat_id,
-            "Volviendo al menú principal…",
-            reply_markup=teclado_menu_principal(),
-        )
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
+    # ----------------- MODO RÁPIDO (firma: CC 123456) -------------------
+    if estado is None:
+        m = _MODO_RAPIDO_RE.match(text)
+        if m:
+            iniciar_consulta_firma(usuario, chat_id, m.group(1).upper(), m.group(2))
+            return
+
+    # ----------------- MENSAJE POR DEFECTO -------------------
+    enviar_mensaje(
+        chat_id,
+        "No entendí tu mensaje.\n\n"
+        "Usa el menú de abajo o el modo rápido para firma: `CC 123456789`.",
+        reply_markup=MENU_PRINCIPAL_JSON,
+    )
 
-    # ----------------- BOTONES DE TIPO DE DOCUMENTO -------------------
-    if text in ("CC - Cédula", "TI - Tarjeta de identidad", "NIT - NIT"):
-        tipo_doc = text.split()[0].upper()
 
-        if estado == "firma_esperando_tipo_doc":
-            set_user_state(chat_id, "firma_esperando_num_doc", {"tipo_doc": tipo_doc})
-            enviar_mensaje(
-                chat_id,
-                f"✍️ Has elegido *firma* con documento tipo *{tipo_doc}*.\n\n"
-                "👉 Escribe ahora el *número de documento* (sin puntos ni comas).",
-            )
-            return jsonify({"ok": True}), 200
+def _comando(text: str) -> str:
+    """
+    "/start payload" -> "/start"; "/saldo@MiBot" -> "/saldo".
+    """
+    return text.split(maxsplit=1)[0].split("@", 1)[0]
 
-        if estado == "persona_esperando_tipo_doc":
-            set_user_state(chat_id, "persona_esperando_num_doc", {"tipo_doc": tipo_doc})
-            enviar_mensaje(
-                chat_id,
-                f"🧍 Has elegido *persona* con documento tipo *{tipo_doc}*.\n\n"
-                "👉 Escribe ahora el *número de documento* (sin puntos ni comas).",
-            )
-            return jsonify({"ok": True}), 200
 
-        enviar_mensaje(
-            chat_id,
-            "Primero elige el tipo de consulta (firma o persona) en el menú principal.",
-            reply_markup=teclado_menu_principal(),
-        )
-        return jsonify({"ok": True}), 200
-
-    # ----------------- LÓGICA SEGÚN ESTADO -------------------
-    if estado == "firma_esperando_num_doc":
-        tipo_doc = datos_estado.get("tipo_doc", "CC")
-        num_doc = text.replace(" ", "")
-        iniciar_consulta_firma(usuario, chat_id, tipo_doc, num_doc)
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
-
-    if estado == "persona_esperando_num_doc":
-        tipo_doc = datos_estado.get("tipo_doc", "CC")
-        num_doc = text.replace(" ", "")
-        iniciar_consulta_persona(usuario, chat_id, tipo_doc, num_doc)
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
-
-    if estado == "esperando_placa_vehiculo":
-        placa = text.strip().upper().replace(" ", "")
-        iniciar_consulta_vehiculo(usuario, chat_id, placa)
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
-
-    if estado == "esperando_placa_propietario":
-        placa = text.strip().upper().replace(" ", "")
-        iniciar_consulta_propietario(usuario, chat_id, placa)
-        set_user_state(chat_id, None)
-        return jsonify({"ok": True}), 200
+# ----------------- COMANDOS -------------------
+# Todos los handlers reciben (usuario, chat_id, text, estado, datos_estado)
 
-    # ----------------- MODO RÁPIDO (firma: CC 123456) -------------------
-    if estado is None and text.upper().startswith(("CC ", "TI ", "CE ", "NIT ")):
-        partes = text.split()
-        if len(partes) >= 2:
-            tipo_doc = partes[0].upper()
-            num_doc = partes[1]
-            iniciar_consulta_firma(usuario, chat_id, tipo_doc, num_doc)
-            return jsonify({"ok": True}), 200
+def handle_start(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, None)
+    return enviar_mensaje(
+        chat_id,
+        textos.MENSAJE_BIENVENIDA,
+        reply_markup=MENU_PRINCIPAL_JSON,
+        as_response=True,
+    )
+
+
+def handle_saldo(usuario, chat_id, text, estado, datos_estado):
+    total, usados = leer_creditos_cacheados(usuario.id)
+    disponibles = max(total - usados, 0)
+
+    msg = FORMATO_SALDO(total=total, usados=usados, disponibles=disponibles)
+    enviar_mensaje(chat_id, msg, reply_markup=MENU_PRINCIPAL_JSON)
+
+
+# ----------------- MENÚ PRINCIPAL -------------------
+
+def handle_firma_menu(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, "firma_esperando_tipo_doc")
+    return enviar_mensaje(
+        chat_id,
+        "✍️ Has elegido *Consulta de firma*.\n\n"
+        "Primero selecciona el *tipo de documento*: 👇",
+        reply_markup=MENU_TIPOS_DOC_JSON,
+        as_response=True,
+    )
+
+
+def handle_persona_menu(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, "persona_esperando_tipo_doc")
+    return enviar_mensaje(
+        chat_id,
+        "🧍 Has elegido *Consulta de persona*.\n\n"
+        "Primero selecciona el *tipo de documento*: 👇",
+        reply_markup=MENU_TIPOS_DOC_JSON,
+        as_response=True,
+    )
+
+
+def handle_vehiculo_menu(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, "esperando_placa_vehiculo")
+    return enviar_mensaje(
+        chat_id,
+        "🚗 Has elegido *Consulta de vehículo por placa*.\n\n"
+        "👉 Escribe ahora la placa del vehículo (ejemplo: `ABC123`).",
+        reply_markup=MENU_PRINCIPAL_JSON,
+        as_response=True,
+    )
+
+
+def handle_propietario_menu(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, "esperando_placa_propietario")
+    return enviar_mensaje(
+        chat_id,
+        "👤 Has elegido *Propietario por placa*.\n\n"
+        "👉 Escribe ahora la placa del vehículo.",
+        reply_markup=MENU_PRINCIPAL_JSON,
+        as_response=True,
+    )
+
+
+def handle_volver_menu(usuario, chat_id, text, estado, datos_estado):
+    set_user_state(chat_id, None)
+    return enviar_mensaje(
+        chat_id,
+        "Volviendo al menú principal…",
+        reply_markup=MENU_PRINCIPAL_JSON,
+        as_response=True,
+    )
+
+
+# ----------------- BOTONES DE TIPO DE DOCUMENTO -------------------
+
+def handle_tipo_documento(usuario, chat_id, text, estado, datos_estado):
+    tipo_doc = text.split()[0].upper()
+
+    if estado == "firma_esperando_tipo_doc":
+        set_user_state(chat_id, "firma_esperando_num_doc", {"tipo_doc": tipo_doc})
+        enviar_mensaje(chat_id, FORMATO_PEDIR_NUM_DOC_FIRMA(tipo_doc=tipo_doc))
+        return
+
+    if estado == "persona_esperando_tipo_doc":
+        set_user_state(chat_id, "persona_esperando_num_doc", {"tipo_doc": tipo_doc})
+        enviar_mensaje(chat_id, FORMATO_PEDIR_NUM_DOC_PERSONA(tipo_doc=tipo_doc))
+        return
 
-    # ----------------- MENSAJE POR DEFECTO -------------------
     enviar_mensaje(
         chat_id,
-        "No entendí tu mensaje.\n\n"
-        "Usa el menú de abajo o el modo rápido para firma: `CC 123456789`.",
-        reply_markup=teclado_menu_principal(),
+        "Primero elige el tipo de consulta (firma o persona) en el menú principal.",
+        reply_markup=MENU_PRINCIPAL_JSON,
     )
-    return jsonify({"ok": True}), 200
+
+
+# ----------------- LÓGICA SEGÚN ESTADO -------------------
+
+def handle_firma_num_doc(usuario, chat_id, text, estado, datos_estado):
+    tipo_doc = datos_estado.get("tipo_doc", "CC")
+    num_doc = text.replace(" ", "")
+    iniciar_consulta_firma(usuario, chat_id, tipo_doc, num_doc)
+    set_user_state(chat_id, None)
+
+
+def handle_persona_num_doc(usuario, chat_id, text, estado, datos_estado):
+    tipo_doc = datos_estado.get("tipo_doc", "CC")
+    num_doc = text.replace(" ", "")
+    iniciar_consulta_persona(usuario, chat_id, tipo_doc, num_doc)
+    set_user_state(chat_id, None)
+
+
+def handle_placa_vehiculo(usuario, chat_id, text, estado, datos_estado):
+    # text ya viene sin espacios extremos; iniciar_consulta_vehiculo la normaliza
+    iniciar_consulta_vehiculo(usuario, chat_id, text)
+    set_user_state(chat_id, None)
+
+
+def handle_placa_propietario(usuario, chat_id, text, estado, datos_estado):
+    # text ya viene sin espacios extremos; iniciar_consulta_propietario la normaliza
+    iniciar_consulta_propietario(usuario, chat_id, text)
+    set_user_state(chat_id, None)
+
+
+COMMAND_HANDLERS = {
+    "/start": handle_start,
+    "/saldo": handle_saldo,
+}
+
+EXACT_HANDLERS = {
+    "📝 Consulta de firma": handle_firma_menu,
+    "🧍 Consulta de persona": handle_persona_menu,
+    "🚗 Consulta de vehículo": handle_vehiculo_menu,
+    "👤 Propietario por placa": handle_propietario_menu,
+    "⬅ Volver al menú": handle_volver_menu,
+    "CC - Cédula": handle_tipo_documento,
+    "TI - Tarjeta de identidad": handle_tipo_documento,
+    "NIT - NIT": handle_tipo_documento,
+}
+
+ESTADO_HANDLERS = {
+    "firma_esperando_num_doc": handle_firma_num_doc,
+    "persona_esperando_num_doc": handle_persona_num_doc,
+    "esperando_placa_vehiculo": handle_placa_vehiculo,
+    "esperando_placa_propietario": handle_placa_propietario,
+}
+
+TIPOS_DOC_MODO_RAPIDO = frozenset({"CC", "TI", "CE", "NIT"})
+# "cc 123456 ..." -> ("cc", "123456"): tipo y número en una sola pasada, sin
+# upper() del mensaje completo ni lista de split()
+_MODO_RAPIDO_RE = re.compile(
+    r"(%s)\s+(\S+)" % "|".join(sorted(TIPOS_DOC_MODO_RAPIDO)), re.IGNORECASE
+)
 
 
 @app.route("/", methods=["GET"])
@@ -2286,6 +3126,12 @@ def index():
 
 
 if __name__ == "__main__":
-    print("Iniciando bot Flask en http://0.0.0.0:5000/ ...")
-    print("Ruta de webhook esperada:", f"/webhook/{WEBHOOK_SECRET_PATH}")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Solo para desarrollo local; en producción se sirve con gunicorn (ver Procfile)
+    log.info("Iniciando bot Flask en http://0.0.0.0:5000/ ...")
+    log.info("Ruta de webhook esperada: /webhook/%s", WEBHOOK_SECRET_PATH)
+    app.run(
+        host="0.0.0.0",
+        port=5000,
+        debug=os.getenv("FLASK_DEBUG", "0") == "1",
+        threaded=True,
+    )